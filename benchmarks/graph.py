@@ -0,0 +1,78 @@
+"""
+Benchmark the module graph traversal of ModuleFinder on a synthetic project.
+
+Modules are generated in memory so only the traversal itself is measured::
+
+ python benchmarks/graph.py --modules 10000 --fan-out 3
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import django
+from django.conf import settings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# We need to set up a few settings to make sure django-compressor loads
+settings.configure(STATIC_ROOT='/tmp/', STATIC_URL='/')
+
+if django.VERSION >= (1, 7):
+    django.setup()
+
+from requirejs.finder import ModuleFinder  # noqa
+
+
+class SyntheticModuleFinder(ModuleFinder):
+    """
+    Module finder serving generated module sources instead of files.
+    """
+
+    def __init__(self, sources, **kwargs):
+        super(SyntheticModuleFinder, self).__init__([], None, **kwargs)
+        self.sources = sources
+
+    def get_module_path(self, module_id):
+        return module_id if module_id in self.sources else None
+
+    def get_module_content(self, path):
+        return self.sources[path]
+
+
+def generate_sources(module_count, fan_out, seed=0):
+    """
+    Generate a tree of modules where every module has fan_out children, with an extra edge from every module to
+    a random later module so the graph shares dependencies.
+    """
+    generator = random.Random(seed)
+    sources = {}
+    for i in range(module_count):
+        dependencies = [c for c in range(i * fan_out + 1, (i + 1) * fan_out + 1) if c < module_count]
+        if i + 1 < module_count:
+            dependencies.append(generator.randrange(i + 1, module_count))
+        sources['module{}'.format(i)] = "define([{}], function() {{}});".format(
+            ', '.join("'module{}'".format(d) for d in dependencies))
+    return sources
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--modules', type=int, default=10000)
+    parser.add_argument('--fan-out', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    finder = SyntheticModuleFinder(generate_sources(args.modules, args.fan_out))
+    timings = []
+    for _ in range(args.repeat):
+        start = time.time()
+        modules = finder.get_modules_from(['module0'])
+        timings.append(time.time() - start)
+
+    print('{} modules found, best of {}: {:.3f}s'.format(len(modules), args.repeat, min(timings)))
+
+
+if __name__ == '__main__':
+    main()
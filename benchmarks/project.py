@@ -0,0 +1,76 @@
+"""
+Generate a synthetic Django project with templates and RequireJS modules to benchmark against.
+"""
+import os
+import random
+
+FILLER_LINE = 'var filler{n} = "{text}";\n'
+TEMPLATE_FILLER = '<p>{text}</p>\n'
+
+
+def generate_project(root, templates=200, modules=2000, depth=8, fan_out=3, named_ratio=0.1, module_size=2048,
+                     template_size=4096, require_ratio=0.5, seed=0):
+    """
+    Write a project to root, with ``templates`` and ``static`` directories.
+
+    Modules are laid out in ``depth`` layers, every module depending on up to ``fan_out`` modules of the next layer.
+    A ``named_ratio`` of the modules is written as named module. Of the templates, a ``require_ratio`` calls
+    require() with modules from the first layer. Files are padded to about ``module_size`` and ``template_size``
+    bytes.
+
+    Returns the template and static directory.
+    """
+    generator = random.Random(seed)
+    template_dir = os.path.join(root, 'templates')
+    static_dir = os.path.join(root, 'static')
+
+    layers = [[] for _ in range(max(depth, 1))]
+    for i in range(modules):
+        layers[i * len(layers) // modules].append('app/module{}'.format(i))
+
+    for layer, next_layer in zip(layers, layers[1:] + [[]]):
+        for module_id in layer:
+            dependencies = generator.sample(next_layer, min(fan_out, len(next_layer)))
+            write(static_dir, module_id + '.js', get_module_source(
+                module_id, dependencies, generator.random() < named_ratio, module_size))
+
+    for i in range(templates):
+        dependencies = []
+        if layers[0] and generator.random() < require_ratio:
+            dependencies = generator.sample(layers[0], min(generator.randint(1, 3), len(layers[0])))
+        write(template_dir, 'pages/page{}.html'.format(i), get_template_source(dependencies, template_size))
+
+    return template_dir, static_dir
+
+
+def get_module_source(module_id, dependencies, named, size):
+    source = 'define({name}[{dependencies}], function() {{\n'.format(
+        name="'{}', ".format(module_id) if named else '',
+        dependencies=', '.join("'{}'".format(d) for d in dependencies),
+    )
+    source += pad(FILLER_LINE, size - len(source))
+    return source + '});\n'
+
+
+def get_template_source(dependencies, size):
+    source = '<html><body>\n'
+    if dependencies:
+        source += "<script>require([{}]);</script>\n".format(', '.join("'{}'".format(d) for d in dependencies))
+    return source + pad(TEMPLATE_FILLER, size - len(source)) + '</body></html>\n'
+
+
+def pad(line, size):
+    lines = []
+    text = 'lorem ipsum ' * 4
+    while size > 0:
+        lines.append(line.format(n=len(lines), text=text))
+        size -= len(lines[-1])
+    return ''.join(lines)
+
+
+def write(directory, name, content):
+    path = os.path.join(directory, name)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(content)
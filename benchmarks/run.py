@@ -0,0 +1,196 @@
+"""
+Benchmark finding modules, writing bundles and generating the RequireJS config on a synthetic project::
+
+ python benchmarks/run.py --templates 500 --modules 2000 --save benchmarks/results.jsonl
+
+For every phase the time, the number of files and bytes read and the peak memory are reported. Every phase starts
+from scratch, with the phases before it run outside of the measurement, so the figures are for that phase alone.
+Saved results are compared with the last saved run using the same parameters.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+import django
+from django.conf import settings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from project import generate_project  # noqa
+
+PHASES = ['templates', 'modules', 'bundles', 'config']
+
+
+class ReadCounter(object):
+    """
+    Count the files opened for reading, and their size, by replacing the builtin open().
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.original_open = None
+        self.lock = threading.Lock()  # Files might be read by a pool of threads
+
+    def __enter__(self):
+        from django.utils.six.moves import builtins
+
+        self.original_open = builtins.open
+
+        def counting_open(file, mode='r', *args, **kwargs):
+            if 'r' in mode and not isinstance(file, int):
+                with self.lock:
+                    self.files += 1
+                    self.bytes += os.path.getsize(file)
+            return self.original_open(file, mode, *args, **kwargs)
+
+        builtins.open = counting_open
+        return self
+
+    def __exit__(self, *exc_info):
+        from django.utils.six.moves import builtins
+
+        builtins.open = self.original_open
+
+
+def measure(func):
+    """
+    Run func, returning its time, reads and peak memory.
+    """
+    if tracemalloc:
+        tracemalloc.start()
+    with ReadCounter() as counter:
+        start = time.time()
+        func()
+        duration = time.time() - start
+    peak_memory = None
+    if tracemalloc:
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {'time': duration, 'files_read': counter.files, 'bytes_read': counter.bytes, 'peak_memory': peak_memory}
+
+
+def run_phases(output_dir):
+    from compressor.cache import cache
+    from requirejs.filter import RequireJSCompiler
+
+    def get_compiler():
+        # Start every phase from scratch
+        cache.clear()
+        shutil.rmtree(output_dir, ignore_errors=True)
+        return RequireJSCompiler('')
+
+    # Every phase builds on what the phases before it found or wrote. The config phase reuses the bundles written.
+    phases = {
+        'templates': lambda compiler: compiler.finder.get_template_dependencies(),
+        'modules': lambda compiler: compiler.finder.modules,
+        'bundles': lambda compiler: compiler.get_bundles(),
+        'config': lambda compiler: compiler.input(),
+    }
+    results = {}
+    for i, phase in enumerate(PHASES):
+        compiler = get_compiler()
+        for earlier_phase in PHASES[:i]:
+            phases[earlier_phase](compiler)
+        results[phase] = measure(lambda: phases[phase](compiler))
+    return results
+
+
+def load_previous(path, parameters):
+    previous = None
+    if path and os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                record = json.loads(line)
+                if record['parameters'] == parameters:
+                    previous = record
+    return previous
+
+
+def report(results, previous=None):
+    print('{:<10} {:>9} {:>8} {:>12} {:>12} {:>9}'.format(
+        'phase', 'time (s)', 'files', 'bytes read', 'peak memory', 'change'))
+    for phase in PHASES:
+        result = results[phase]
+        change = ''
+        # Runs saved before phases were measured on their own have other phases
+        previous_result = previous['results'].get(phase) if previous else None
+        if previous_result and previous_result['time']:
+            change = '{:+.0%}'.format(result['time'] / previous_result['time'] - 1)
+        print('{:<10} {:>9.3f} {:>8} {:>12} {:>12} {:>9}'.format(
+            phase, result['time'], result['files_read'], result['bytes_read'],
+            result['peak_memory'] if result['peak_memory'] is not None else '-', change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--templates', type=int, default=200)
+    parser.add_argument('--modules', type=int, default=2000)
+    parser.add_argument('--depth', type=int, default=8)
+    parser.add_argument('--fan-out', type=int, default=3)
+    parser.add_argument('--named-ratio', type=float, default=0.1)
+    parser.add_argument('--module-size', type=int, default=2048)
+    parser.add_argument('--template-size', type=int, default=4096)
+    parser.add_argument('--setting', action='append', default=[], metavar='NAME=JSON',
+                        help="Extra Django setting, like REQUIREJS_SCAN_WORKERS=4. Use multiple times for more.")
+    parser.add_argument('--save', metavar='PATH', help="Append the results to this file")
+    args = parser.parse_args()
+
+    parameters = {
+        'templates': args.templates, 'modules': args.modules, 'depth': args.depth, 'fan_out': args.fan_out,
+        'named_ratio': args.named_ratio, 'module_size': args.module_size, 'template_size': args.template_size,
+        'settings': sorted(args.setting),
+    }
+
+    root = tempfile.mkdtemp()
+    try:
+        template_dir, static_dir = generate_project(
+            root, templates=args.templates, modules=args.modules, depth=args.depth, fan_out=args.fan_out,
+            named_ratio=args.named_ratio, module_size=args.module_size, template_size=args.template_size)
+        output_dir = os.path.join(root, 'output')
+
+        extra_settings = {}
+        for setting in args.setting:
+            name, value = setting.split('=', 1)
+            extra_settings[name] = json.loads(value)
+        settings.configure(
+            USE_I18N=False,
+            STATIC_ROOT=output_dir,
+            STATIC_URL='/static/',
+            STATICFILES_DIRS=[static_dir],
+            STATICFILES_FINDERS=[
+                'django.contrib.staticfiles.finders.FileSystemFinder',
+                'compressor.finders.CompressorFinder',
+            ],
+            TEMPLATE_DIRS=[template_dir],
+            INSTALLED_APPS=['django.contrib.staticfiles', 'compressor'],
+            COMPRESS_ENABLED=True,
+            **extra_settings
+        )
+        if django.VERSION >= (1, 7):
+            django.setup()
+
+        results = run_phases(os.path.join(output_dir, 'CACHE'))
+    finally:
+        shutil.rmtree(root)
+
+    previous = load_previous(args.save, parameters)
+    report(results, previous)
+
+    if args.save:
+        with open(args.save, 'a') as f:
+            f.write(json.dumps({'time': time.time(), 'parameters': parameters, 'results': results}) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+import os
+import heapq
+import hashlib
+from collections import OrderedDict
+
+from django.utils.six import text_type
+
+
+def split_by_entries(entries, modules, get_modules, shared_minimum=2):
+    """
+    Split modules into bundles per entry, like the templates of a project calling require().
+
+    ``entries`` maps entry names to their dependencies, and ``get_modules`` returns all modules needed for a list of
+    dependencies. Modules needed by at least ``shared_minimum`` entries go into the ``shared`` bundle, modules needed
+    by a single entry into a bundle for that entry, and modules needed by a few entries into a bundle for just those
+    entries.
+
+    Returns a list of (name, modules) for the bundles and the modules not needed by any entry, keeping the order of
+    ``modules`` within each of them.
+    """
+    users = OrderedDict((get_key(m), []) for m in modules)
+    for name, dependencies in entries.items():
+        for module in get_modules(dependencies):
+            if get_key(module) in users:
+                users[get_key(module)].append(name)
+
+    bundles = OrderedDict()
+    remaining = []
+    for module in modules:
+        names = users[get_key(module)]
+        if not names:
+            remaining.append(module)
+        elif len(names) >= shared_minimum:
+            bundles.setdefault('shared', []).append(module)
+        elif len(names) == 1:
+            bundles.setdefault(get_entry_bundle_name(names[0]), []).append(module)
+        else:
+            key = hashlib.md5('\n'.join(sorted(names)).encode('utf-8')).hexdigest()[:8]
+            bundles.setdefault('shared-{}'.format(key), []).append(module)
+
+    return sorted(bundles.items()), remaining
+
+
+def pack_by_size(modules, get_size, target_size):
+    """
+    Pack modules into bundles of at most ``target_size`` bytes, as measured by ``get_size``, named ``main-<key>``.
+
+    Modules which have to stay together (see ``get_clusters``) are ordered by their first id, and a bundle is closed
+    when the next cluster would not fit, or once it is half full at a cluster whose id hashes to a cut point. Cut
+    points only depend on the ids around them, so a changed or added module only changes its own bundle and maybe the
+    next, and the other bundles keep their modules, and with that their fingerprint.
+
+    Returns a list of (name, modules) for the bundles, keeping the order of ``modules`` within each of them.
+    """
+    clusters = sorted(get_clusters(modules), key=lambda c: min(m.id for m in c))
+    positions = dict((get_key(m), i) for i, m in enumerate(modules))
+
+    packs = []
+    current, size = [], 0
+    for cluster in clusters:
+        cluster_size = sum(get_size(m) for m in cluster)
+        if current and size + cluster_size > target_size:
+            packs.append(current)
+            current, size = [], 0
+        current.extend(cluster)
+        size += cluster_size
+        if size >= target_size // 2 and is_cut_point(min(m.id for m in cluster)):
+            packs.append(current)
+            current, size = [], 0
+    if current:
+        packs.append(current)
+
+    bundles = []
+    for pack in packs:
+        key = hashlib.md5(min(m.id for m in pack).encode('utf-8')).hexdigest()[:8]
+        bundles.append(('main-{}'.format(key), sorted(pack, key=lambda m: positions[get_key(m)])))
+    return bundles
+
+
+def is_cut_point(module_id):
+    return int(hashlib.md5(module_id.encode('utf-8')).hexdigest()[:4], 16) % 4 == 0
+
+
+def get_clusters(modules):
+    """
+    Group modules which have to stay together: modules depending on each other in a cycle, the strongly connected
+    components of the dependency graph, and modules defined in the same file.
+
+    Returns a list of clusters, keeping the order of ``modules`` within each of them.
+    """
+    by_id, by_location = {}, {}
+    for module in modules:
+        by_id.setdefault(module.id, []).append(get_key(module))
+        by_location.setdefault(module.location, []).append(get_key(module))
+
+    edges = {}
+    for module in modules:
+        targets = list(by_location[module.location])
+        for dependency in module.dependencies:
+            targets.extend(by_id.get(dependency.split('!')[0], []))
+        edges[get_key(module)] = targets
+
+    # Tarjan's algorithm, without recursion since dependency chains can be long
+    index, low, components = {}, {}, {}
+    stack, on_stack = [], set()
+    for root in edges:
+        if root in index:
+            continue
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(edges[root]))]
+        while work:
+            node, targets = work[-1]
+            for target in targets:
+                if target not in index:
+                    index[target] = low[target] = len(index)
+                    stack.append(target)
+                    on_stack.add(target)
+                    work.append((target, iter(edges[target])))
+                    break
+                elif target in on_stack:
+                    low[node] = min(low[node], index[target])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        components[member] = node
+                        if member == node:
+                            break
+
+    clusters = OrderedDict()
+    for module in modules:
+        clusters.setdefault(components[get_key(module)], []).append(module)
+    return list(clusters.values())
+
+
+def sort_by_dependencies(modules):
+    """
+    Order modules so that every module comes after the modules it depends on, and otherwise by id and location. This
+    makes bundles come out the same, whatever order the modules were found in.
+
+    Modules depending on each other in a cycle cannot all come first; the cycle is broken at the first module by id.
+    """
+    by_key = OrderedDict((get_key(m), m) for m in modules)
+    by_id = {}
+    for key, module in by_key.items():
+        by_id.setdefault(module.id, []).append(key)
+
+    waiting = {}
+    dependents = dict((key, []) for key in by_key)
+    for key, module in by_key.items():
+        dependencies = set()
+        for dependency in module.dependencies:
+            dependencies.update(by_id.get(dependency.split('!')[0], []))
+        dependencies.discard(key)
+        waiting[key] = len(dependencies)
+        for dependency in dependencies:
+            dependents[dependency].append(key)
+
+    ready = [key for key in by_key if not waiting[key]]
+    heapq.heapify(ready)
+    remaining = set(by_key)
+    ordered = []
+    while remaining:
+        if not ready:
+            key = min(remaining)
+            waiting[key] = 0
+            ready.append(key)
+        key = heapq.heappop(ready)
+        remaining.discard(key)
+        ordered.append(by_key[key])
+        for dependent in dependents[key]:
+            waiting[dependent] -= 1
+            if waiting[dependent] == 0:
+                heapq.heappush(ready, dependent)
+    return ordered
+
+
+def get_entry_bundle_name(name):
+    """
+    Turn the name of an entry like ``website/home.html`` into a name for its bundle, like ``website-home``.
+    """
+    return os.path.splitext(name)[0].replace('/', '-')
+
+
+def get_key(module):
+    """
+    Modules are unique by their id and location.
+    """
+    return module.id, module.location
+
+
+def splice_id(module_id, content, offsets, charset='utf-8'):
+    """
+    Yield the pieces of content with the quoted module id inserted at the given offsets, which is how unnamed define()
+    calls are named when bundling them. Pieces come as (piece, inserted) pairs.
+
+    Content can be text, bytes or a memory map, which is only sliced around the offsets. Without offsets, the content
+    is passed on as it is.
+    """
+    splice = '"{}", '.format(module_id)
+    if not isinstance(content, text_type):
+        splice = splice.encode(charset)
+
+    start = 0
+    for offset in offsets:
+        yield content[start:offset], False
+        yield splice, True
+        start = offset
+    yield content[start:] if start else content, False
@@ -0,0 +1,226 @@
+import os
+import json
+import tempfile
+import threading
+from collections import OrderedDict
+
+from .utils import get_cache
+
+# Bump when the format of cached scan results changes
+CACHE_VERSION = 3
+
+
+class GraphCache(object):
+    """
+    Persistent store for the results of scanning templates and modules.
+
+    Entries are stored per section (``templates``, ``modules``, ``leaves``, ``digests``) and keyed by path. Each entry
+    remembers the mtime and size of the file it was created from, so a changed file is detected without reading it.
+    """
+
+    def __init__(self):
+        self.entries = None
+        self.dirty = False
+        # Guards loading and changing the entries, since modules can be scanned by several threads
+        self.lock = threading.Lock()
+
+    def get(self, section, path):
+        """
+        Return the cached value for path, or None if there is none or the file changed since.
+        """
+        entry = self.get_entries().get(section, {}).get(path)
+        if entry is not None:
+            mtime, size, value = entry
+            if [mtime, size] == self.get_signature(path):
+                return value
+
+    def set(self, section, path, value):
+        entry = self.get_signature(path) + [value]
+        entries = self.get_entries()
+        with self.lock:
+            entries.setdefault(section, {})[path] = entry
+            self.dirty = True
+
+    def get_entries(self):
+        with self.lock:
+            if self.entries is None:
+                data = self.load()
+                if data and data.get('version') == CACHE_VERSION:
+                    self.entries = data.get('entries', {})
+                else:
+                    self.entries = {}
+            return self.entries
+
+    def save(self):
+        """
+        Persist the entries, but only when something has changed.
+        """
+        with self.lock:
+            if self.dirty:
+                self.store({'version': CACHE_VERSION, 'entries': self.entries})
+                self.dirty = False
+
+    @staticmethod
+    def get_signature(path):
+        stat = os.stat(path)
+        return [stat.st_mtime, stat.st_size]
+
+    def load(self):
+        raise NotImplementedError
+
+    def store(self, data):
+        raise NotImplementedError
+
+
+class FileGraphCache(GraphCache):
+    """
+    Graph cache stored as a JSON file on disk.
+    """
+
+    def __init__(self, location):
+        super(FileGraphCache, self).__init__()
+        self.location = location
+
+    def load(self):
+        try:
+            with open(self.location, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def store(self, data):
+        # Write to a temporary file first so concurrent readers never see a partial file
+        directory = os.path.dirname(os.path.abspath(self.location))
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(temp_path, self.location)
+
+
+class DjangoGraphCache(GraphCache):
+    """
+    Graph cache stored in one of the configured Django cache backends.
+    """
+    key = 'requirejs.graph'
+
+    def __init__(self, alias):
+        super(DjangoGraphCache, self).__init__()
+        self.cache = get_cache(alias)
+
+    def load(self):
+        return self.cache.get(self.key)
+
+    def store(self, data):
+        self.cache.set(self.key, data, None)
+
+
+class LRUCache(object):
+    """
+    Small in-process cache which keeps the most recently used entries, up to a maximum number of entries.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.entries[key] = value  # Mark as most recently used
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class FilterCache(object):
+    """
+    Store for the filtered output of single modules, keyed by a hash of their content and the filters.
+    """
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, output):
+        raise NotImplementedError
+
+
+class FileFilterCache(FilterCache):
+    """
+    Filter cache stored as a file per module in a directory on disk.
+    """
+
+    def __init__(self, location):
+        self.location = location
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.location, '{}.js'.format(key)), 'rb') as f:
+                return f.read().decode('utf-8')
+        except (IOError, OSError):
+            return None
+
+    def set(self, key, output):
+        if not os.path.isdir(self.location):
+            try:
+                os.makedirs(self.location)
+            except OSError:
+                pass  # Created by another thread in the meantime
+        fd, temp_path = tempfile.mkstemp(dir=self.location, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(output.encode('utf-8'))
+        os.rename(temp_path, os.path.join(self.location, '{}.js'.format(key)))
+
+
+class DjangoFilterCache(FilterCache):
+    """
+    Filter cache stored in one of the configured Django cache backends.
+    """
+    key_prefix = 'requirejs.filtered.'
+
+    def __init__(self, alias):
+        self.cache = get_cache(alias)
+
+    def get(self, key):
+        return self.cache.get(self.key_prefix + key)
+
+    def set(self, key, output):
+        self.cache.set(self.key_prefix + key, output, None)
+
+
+def get_filter_cache(location):
+    """
+    Return a filter cache for the ``REQUIREJS_MODULE_FILTER_CACHE`` setting, which is either the alias of a
+    configured Django cache or the path of a directory.
+    """
+    from django.conf import settings
+
+    if not location:
+        return None
+    if location in getattr(settings, 'CACHES', {}):
+        return DjangoFilterCache(location)
+    return FileFilterCache(location)
+
+
+def get_graph_cache(location):
+    """
+    Return a graph cache for the ``REQUIREJS_GRAPH_CACHE`` setting, which is either the alias of a
+    configured Django cache or the path of a file.
+    """
+    from django.conf import settings
+
+    if not location:
+        return None
+    if location in getattr(settings, 'CACHES', {}):
+        return DjangoGraphCache(location)
+    return FileGraphCache(location)
@@ -1,12 +1,18 @@
+from collections import OrderedDict
 from copy import deepcopy
 from itertools import chain
-import re
+from multiprocessing.pool import ThreadPool
+import hashlib
 import json
+import mmap
+import os
+import threading
+import time
 
-from django.utils.six import text_type
+from django.utils.six import text_type, binary_type
+from django.utils.encoding import smart_bytes
 from django.utils.safestring import mark_safe
 from django.contrib.staticfiles import finders
-from django.core.files.base import ContentFile
 
 
 # noinspection PyPackageRequirements
@@ -14,16 +20,53 @@ from compressor.conf import settings
 # noinspection PyPackageRequirements
 from compressor.filters.base import FilterBase
 
+from .bundling import pack_by_size, sort_by_dependencies, split_by_entries, splice_id
+from .cache import get_filter_cache, get_graph_cache, LRUCache
 from .finder import ModuleFinder
+from .manifest import get_manifest, get_manifest_version
+from .scanner import scan
+from .signals import send_bundle_written, send_phase_finished
 from .utils import get_installed_app_labels, get_app_template_dirs
-from .js import JsCompressor
-
-define_replace_pattern = re.compile(r'define\s*\(([^\)]*?)\)')
+from .watcher import get_watcher
+from .writer import BundleWriter, SourceChunk, UploadQueue
 
 CONFIG = settings.REQUIREJS_CONFIG if hasattr(settings, 'REQUIREJS_CONFIG') else {}
 APP_ALIAS = settings.REQUIREJS_APP_ALIAS if hasattr(settings, 'REQUIREJS_APP_ALIAS') else None
 INCLUDE_MAIN_BUNDLE = settings.REQUIREJS_INCLUDE_MAIN_BUNDLE \
     if hasattr(settings, 'REQUIREJS_INCLUDE_MAIN_BUNDLE') else False
+GRAPH_CACHE = settings.REQUIREJS_GRAPH_CACHE if hasattr(settings, 'REQUIREJS_GRAPH_CACHE') else None
+SCAN_WORKERS = settings.REQUIREJS_SCAN_WORKERS if hasattr(settings, 'REQUIREJS_SCAN_WORKERS') else None
+BUNDLE_WORKERS = settings.REQUIREJS_BUNDLE_WORKERS if hasattr(settings, 'REQUIREJS_BUNDLE_WORKERS') else None
+STATIC_INDEX = settings.REQUIREJS_STATIC_INDEX if hasattr(settings, 'REQUIREJS_STATIC_INDEX') else False
+SPLIT_BUNDLES = settings.REQUIREJS_SPLIT_BUNDLES if hasattr(settings, 'REQUIREJS_SPLIT_BUNDLES') else None
+UPLOAD_WORKERS = settings.REQUIREJS_UPLOAD_WORKERS if hasattr(settings, 'REQUIREJS_UPLOAD_WORKERS') else None
+LEAF_MODULES = settings.REQUIREJS_LEAF_MODULES if hasattr(settings, 'REQUIREJS_LEAF_MODULES') else None
+LEAF_SIZE = settings.REQUIREJS_LEAF_SIZE if hasattr(settings, 'REQUIREJS_LEAF_SIZE') else None
+LEAF_LINE_LENGTH = settings.REQUIREJS_LEAF_LINE_LENGTH if hasattr(settings, 'REQUIREJS_LEAF_LINE_LENGTH') else None
+TEMPLATE_INCLUDE = settings.REQUIREJS_TEMPLATE_INCLUDE if hasattr(settings, 'REQUIREJS_TEMPLATE_INCLUDE') else None
+TEMPLATE_EXCLUDE = settings.REQUIREJS_TEMPLATE_EXCLUDE if hasattr(settings, 'REQUIREJS_TEMPLATE_EXCLUDE') else None
+MAIN_BUNDLE_SIZE = settings.REQUIREJS_MAIN_BUNDLE_SIZE if hasattr(settings, 'REQUIREJS_MAIN_BUNDLE_SIZE') else None
+MODULE_FILTER_CACHE = settings.REQUIREJS_MODULE_FILTER_CACHE \
+    if hasattr(settings, 'REQUIREJS_MODULE_FILTER_CACHE') else None
+SOURCE_MAPS = settings.REQUIREJS_SOURCE_MAPS if hasattr(settings, 'REQUIREJS_SOURCE_MAPS') else False
+PRECOMPRESS = settings.REQUIREJS_PRECOMPRESS if hasattr(settings, 'REQUIREJS_PRECOMPRESS') else None
+MANIFEST = settings.REQUIREJS_MANIFEST if hasattr(settings, 'REQUIREJS_MANIFEST') else None
+OUTPUT_CACHE_SIZE = settings.REQUIREJS_OUTPUT_CACHE_SIZE if hasattr(settings, 'REQUIREJS_OUTPUT_CACHE_SIZE') else 32
+WATCH = settings.REQUIREJS_WATCH if hasattr(settings, 'REQUIREJS_WATCH') else False
+BUNDLE_VERSION = settings.REQUIREJS_BUNDLE_VERSION if hasattr(settings, 'REQUIREJS_BUNDLE_VERSION') else None
+
+# Bump when bundles come out differently from the same modules, so bundles written by older versions are not reused
+BUNDLE_FORMAT = 1
+
+# The settings our output depends on which are only read on startup, as part of the key of the output cache
+SETTINGS_FINGERPRINT = json.dumps([CONFIG, APP_ALIAS, INCLUDE_MAIN_BUNDLE], sort_keys=True)
+
+# Output of the filter per data-main, settings and RequireJS source. Clear it when modules changed.
+output_cache = LRUCache(OUTPUT_CACHE_SIZE)
+
+# Watched module finders per data-main, shared by all compilers in this process when ``REQUIREJS_WATCH`` is set
+watched_finders = {}
+watched_finders_lock = threading.Lock()
 
 
 class RequireJSCompiler(FilterBase):
@@ -32,39 +75,144 @@ class RequireJSCompiler(FilterBase):
         self.attrs = attrs
 
         # Get possible data-main="<module>" from attributes
-        main = self.attrs.get("data-main", "").strip() if self.attrs else None
-        self.finder = self.get_module_finder(main=main)
+        self.main = self.attrs.get("data-main", "").strip() if self.attrs else None
+        self._finder = None
+        self.reused_bundles = []
+        # Bundle paths known to exist and the upload queue, while writing bundles
+        self.existing_bundles = None
+        self.uploads = None
+        self._paths = None
 
         super(RequireJSCompiler, self).__init__(content, filter_type, filename)
 
-    # noinspection PyMethodMayBeStatic
+    @property
+    def finder(self):
+        """
+        The ModuleFinder, only created when modules need to be found.
+        """
+        if self._finder is None:
+            self._finder = self.get_module_finder(main=self.main)
+        return self._finder
+
+    @finder.setter
+    def finder(self, finder):
+        self._finder = finder
+
     def get_module_finder(self, main=None):
-        template_directories = settings.TEMPLATE_DIRS + get_app_template_dirs()
+        """
+        Create a ModuleFinder for main, or, when watching files, get the finder shared for main in this process.
+        """
+        if not WATCH:
+            return self.create_module_finder(main=main)
+        with watched_finders_lock:
+            if main not in watched_finders:
+                watched_finders[main] = self.create_module_finder(main=main, watcher=get_watcher())
+            return watched_finders[main]
+
+    # noinspection PyMethodMayBeStatic
+    def create_module_finder(self, main=None, watcher=None):
+        template_directories = list(settings.TEMPLATE_DIRS) + get_app_template_dirs()
         shim_dependencies = list(chain(*[s.get('deps', []) for s in CONFIG.get('shim', {}).values()]))
         main_dependency = [main] if main else []
         dependencies = shim_dependencies + main_dependency
         aliases = CONFIG.get('paths', {})
         return ModuleFinder(template_directories, finders,
-                            app_alias=APP_ALIAS, starting_dependencies=dependencies, aliases=aliases)
+                            app_alias=APP_ALIAS, starting_dependencies=dependencies, aliases=aliases,
+                            cache=get_graph_cache(GRAPH_CACHE), workers=SCAN_WORKERS, charset=settings.FILE_CHARSET,
+                            static_index=STATIC_INDEX, watcher=watcher, leaf_patterns=LEAF_MODULES,
+                            leaf_size=LEAF_SIZE, leaf_line_length=LEAF_LINE_LENGTH,
+                            template_include=TEMPLATE_INCLUDE, template_exclude=TEMPLATE_EXCLUDE)
 
     def input(self, **kwargs):
+        if WATCH and self.needs_modules():
+            # Look for changed files once, instead of on everything asked from the watched finder
+            with self.finder.refreshed():
+                return self.get_output()
+        return self.get_output()
+
+    def get_output(self):
+        cache_key = self.get_output_cache_key()
+        if cache_key is not None:
+            output = output_cache.get(cache_key)
+            if output is not None:
+                return output
+
         if self.filename:
             with open(self.filename, 'r') as f:
                 require_content = f.read()
         else:
             require_content = self.content
 
+        config, main_bundle = self.get_require_config()
+        require_content += main_bundle
+
+        output = text_type("var require = {config};{content}").format(
+            config=json.dumps(config), content=require_content)
+        if cache_key is not None:
+            output_cache.set(cache_key, output)
+        return output
+
+    def get_output_cache_key(self):
+        """
+        Key for our output in the output cache, based on ``data-main``, the settings, the RequireJS source and the
+        manifest.
+
+        The output can only be cached when it does not depend on the modules found, so when not compressing or when
+        the config is taken from the manifest. When watching files, the version of the watched finder is part of the
+        key instead. Otherwise, this returns None.
+        """
+        if not OUTPUT_CACHE_SIZE:
+            return None
+        finder_version = None
+        if self.needs_modules():
+            if not WATCH:
+                return None
+            self.finder.refresh()
+            finder_version = self.finder.version
+
+        if self.filename:
+            stat = os.stat(self.filename)
+            source = [self.filename, stat.st_mtime, stat.st_size]
+        else:
+            source = hashlib.md5(smart_bytes(self.content)).hexdigest()
+        return (self.main, SETTINGS_FINGERPRINT, settings.STATIC_URL, settings.COMPRESS_ENABLED, json.dumps(source),
+                get_manifest_version(), finder_version)
+
+    def needs_modules(self):
+        """
+        Whether our output depends on the modules found, which it does when compressing, unless the manifest has
+        an entry for our ``data-main``.
+        """
+        return settings.COMPRESS_ENABLED and not (MANIFEST and (self.main or '') in get_manifest(MANIFEST))
+
+    def get_require_config(self, forced=False):
+        """
+        Generate the RequireJS config, and the ``main`` bundle if it should be included with RequireJS.
+
+        When compressing, these are taken from the manifest written by the ``requirejs_manifest`` command if it
+        has an entry for our ``data-main``, so no modules need to be found at all.
+        """
+        start = time.time()
+        enabled = settings.COMPRESS_ENABLED or forced
+        if enabled and MANIFEST and not forced:
+            entry = get_manifest(MANIFEST).get(self.main or '')
+            if entry is not None:
+                send_phase_finished(self.__class__, 'config', time.time() - start, manifest=1)
+                return entry['config'], entry['main_bundle']
+
         config = self.get_default_config()
-        if settings.COMPRESS_ENABLED:
+        main_bundle = ''
+        if enabled:
             bundles, main_modules = self.get_bundles(skip_main_bundle=INCLUDE_MAIN_BUNDLE)
             if bundles:
                 config.update({'bundles': bundles})
             if INCLUDE_MAIN_BUNDLE:  # Add the main bundle to the require content written
-                require_content += '\n'.join([self.get_bundle_module(module) for module in main_modules])
+                main_bundle = '\n'.join([self.get_bundle_module(module) for module in main_modules])
         elif 'bundles' in config:
             del config['bundles']  # Only write bundles when we compress
 
-        return text_type("var require = {config};{content}").format(config=json.dumps(config), content=require_content)
+        send_phase_finished(self.__class__, 'config', time.time() - start, manifest=0)
+        return config, main_bundle
 
     def output(self, **kwargs):
         raise NotImplementedError
@@ -74,59 +222,158 @@ class RequireJSCompiler(FilterBase):
     #
 
     @staticmethod
-    def get_bundle_content(module, original_content):
+    def get_bundle_content(module, original_content, splices=None):
         """
         Rewrite the module to include it's module path so it can be included in a bundle.
 
+        The module id is spliced into the unnamed define() calls at the given offsets, which are offsets in the
+        encoded content. When no offsets are given, the content is scanned for them.
+
         Returns the rewritten content of the module and None if no define-call was found.
         """
-        text_content = text_type(original_content, settings.FILE_CHARSET)
-        define_call = define_replace_pattern.findall(text_content)
-        if define_call:
-            if not module.named:
-                return define_replace_pattern.sub(
-                    r'define("{module}", \1)'.format(module=module.id),
-                    text_content,
-                    re.MULTILINE
-                )
-            else:
-                return text_content
+        if splices is not None:
+            if isinstance(original_content, text_type):
+                original_content = original_content.encode(settings.FILE_CHARSET)
+            pieces = splice_id(module.id, original_content, [] if module.named else splices, settings.FILE_CHARSET)
+            return b''.join(piece for piece, inserted in pieces).decode(settings.FILE_CHARSET)
+
+        if isinstance(original_content, binary_type):
+            text_content = text_type(original_content, settings.FILE_CHARSET)
+        else:
+            text_content = original_content
+
+        calls = [c for c in scan(text_content) if c.function == 'define']
+        if not calls:
+            return None
+        if module.named:
+            return text_content
+        pieces = splice_id(module.id, text_content, [c.offset for c in calls if c.name is None])
+        return ''.join(piece for piece, inserted in pieces)
 
     def get_bundle_module(self, module):
         """
         Rewrite a module into a bundle, which means we have to add the name of the module into the define() call
         """
+        path, info = self.get_bundle_source(module)
+        content = self.get_bundle_content(module, self.finder.get_module_content(path), info.splices)
+        if content is None:
+            raise ValueError("Module {} is not an AMD module".format(module.id))
+        return content
+
+    def get_bundle_chunks(self, module):
+        """
+        Get the module rewritten into a bundle as a SourceChunk of pieces of bytes, without decoding it.
+
+        The module file is memory mapped, so a module which needs no rewriting is passed on as it is, and other
+        modules are only sliced around the offsets the module id is spliced into.
+        """
+        return SourceChunk(self.get_module_url(module), self.get_bundle_pieces(module))
+
+    def get_bundle_pieces(self, module):
+        path, info = self.get_bundle_source(module)
+        with open(path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return  # Empty files cannot be mapped
+            source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for piece, inserted in splice_id(
+                    module.id, source, [] if module.named else info.splices, settings.FILE_CHARSET):
+                yield piece, inserted
+        finally:
+            source.close()
+
+    def get_module_url(self, module):
+        """
+        The URL RequireJS would load the module from without bundles, using the ``paths`` of the config.
+        """
+        if self._paths is None:
+            self._paths = self.get_default_config().get('paths', {})
+
+        name = module.location
+        for prefix in sorted(self._paths, key=len, reverse=True):
+            if name == prefix or name.startswith(prefix + '/'):
+                path = self._paths[prefix]
+                name = (path[0] if isinstance(path, list) else path) + name[len(prefix):]
+                break
+        if name.startswith('/') or '://' in name:
+            return '{}.js'.format(name)
+        return '{}{}.js'.format(settings.STATIC_URL, name)
+
+    def get_bundle_source(self, module):
+        """
+        Get the path and ModuleInfo of the file of a module to bundle.
+        """
         path = self.finder.get_module_path(module.location)
         if not path:
             raise ValueError("Could not find module {} on disk".format(module.id))
 
-        with open(path, 'r') as f:
-            bundle_module = self.get_bundle_content(module, f.read())
-            if bundle_module is None:
-                raise ValueError("Module {} is not an AMD module".format(module.id))
-            return bundle_module
+        info = self.finder.get_module_info(path)
+        if not info.defined:
+            raise ValueError("Module {} is not an AMD module".format(module.id))
+        return path, info
 
-    def write_bundle(self, basename, modules):
+    def get_bundle_fingerprint(self, basename, modules):
         """
-        Let compressor write the bundled modules with a basename.
+        Fingerprint the input of a bundle: its name, its modules and their content, and the filters it will be
+        passed through with their settings. Bundles with an unchanged fingerprint do not need to be written again.
+        ``REQUIREJS_BUNDLE_VERSION`` is part of it as well, to write all bundles again when something else changed.
+
+        The modules are sorted, so the fingerprint only depends on what is in the bundle, and can be computed
+        without filtering anything. With source maps, the URLs of the modules, which end up in the map, are
+        taken into account as well.
         """
-        bundles = [self.get_bundle_module(module) for module in modules]
-        return self.write_output('\n'.join(bundles), '{name}.js'.format(name=basename))
+        if SOURCE_MAPS:
+            source_map = [settings.STATIC_URL, self.get_default_config().get('paths', {})]
+        else:
+            source_map = None
+        fingerprint = hashlib.md5()
+        fingerprint.update(json.dumps([
+            BUNDLE_FORMAT, BUNDLE_VERSION, basename, list(settings.COMPRESS_JS_FILTERS), self.get_filter_settings(),
+            settings.FILE_CHARSET, source_map
+        ], sort_keys=True, default=repr).encode('utf-8'))
+        members = []
+        for module in modules:
+            digest = self.finder.get_module_digest(self.finder.get_module_path(module.location))
+            members.append(json.dumps([module.id, module.location, module.named, digest]))
+        for member in sorted(members):
+            fingerprint.update(member.encode('utf-8'))
+        return fingerprint.hexdigest()
 
     @staticmethod
-    def write_output(content, basename):
+    def get_filter_settings():
         """
-        Leverage django-compressor's JsCompressor to write the Javascript, making use of configured filters
-        and other settings.
+        Get the settings of compressor's filters which change their output, like
+        ``COMPRESS_CLOSURE_COMPILER_ARGUMENTS`` or ``COMPRESS_YUGLIFY_BINARY``.
         """
-        # Compress it
-        compressor = JsCompressor()
-        filtered = compressor.filter(content, compressor.cached_filters, method='input', kind='js')
-        output = compressor.filter_output(filtered)
-        path = compressor.get_filepath(output, basename=basename)
-        # Write it
-        compressor.storage.save(path, ContentFile(output.encode(compressor.charset)))
-        return mark_safe(compressor.storage.url(path))
+        return sorted((name, getattr(settings, name)) for name in dir(settings)
+                      if name.startswith('COMPRESS_') and name.endswith(('_ARGUMENTS', '_BINARY')))
+
+    def write_bundle(self, basename, modules):
+        """
+        Let compressor write the bundled modules with a basename.
+
+        The bundle is named by its fingerprint instead of its filtered content, so a bundle which already exists in
+        compressor's storage, written by this or any other process sharing the storage, is neither filtered nor
+        saved again.
+        """
+        writer = self.get_bundle_writer()
+        filename = '{name}.js'.format(name=basename)
+        fingerprint = self.get_bundle_fingerprint(basename, modules)
+        path = writer.get_filepath(fingerprint, filename)
+        if not writer.is_written(path):
+            # Modules are read and rewritten one at a time while the writer consumes them
+            bundle_modules = (self.get_bundle_chunks(module) for module in modules)
+            path = writer.write(bundle_modules, filename, digest=fingerprint)
+            send_bundle_written(self.__class__, basename, path, len(modules), reused=False, **writer.stats)
+        else:
+            self.reused_bundles.append(basename)
+            send_bundle_written(self.__class__, basename, path, len(modules), reused=True)
+        return mark_safe(writer.storage.url(path))
+
+    def get_bundle_writer(self):
+        return BundleWriter(existing=self.existing_bundles, uploads=self.uploads,
+                            filter_cache=get_filter_cache(MODULE_FILTER_CACHE), source_maps=SOURCE_MAPS,
+                            precompress=PRECOMPRESS)
 
     #
     # RequireJS config generation
@@ -140,23 +387,79 @@ class RequireJSCompiler(FilterBase):
         """
         shims = CONFIG.get('shim', {})
         modules = [m for m in self.finder.modules if m.id not in shims]
-        bundles = {}
+        members = []
         configured_bundles = CONFIG.get('bundles', {})
         if configured_bundles:
             # Let the configured bundles get generated, leaving the remaining modules for the ``main`` bundle.
-            for name, bundle_module_ids in configured_bundles.items():
+            for name, bundle_module_ids in sorted(configured_bundles.items()):
                 bundle_modules = [m for m in modules if m.id in bundle_module_ids]
-                bundle_path = self.write_bundle(name, bundle_modules)
-                bundles[bundle_path] = [m.id for m in bundle_modules]
-                for m in bundle_modules:
-                    modules.remove(m)
+                members.append((name, bundle_modules))
+                modules = [m for m in modules if m.id not in bundle_module_ids]
+
+        # Split the remaining modules by the templates using them, if configured
+        if modules and SPLIT_BUNDLES:
+            split_bundles, modules = split_by_entries(
+                self.finder.get_template_entries(), modules, self.finder.get_modules_from, SPLIT_BUNDLES)
+            members.extend(split_bundles)
+
+        # Pack the remaining modules into bundles of about the configured size, instead of one ``main`` bundle,
+        # unless the ``main`` bundle is included with RequireJS
+        if modules and MAIN_BUNDLE_SIZE and not skip_main_bundle:
+            members.extend(pack_by_size(modules, self.get_module_size, MAIN_BUNDLE_SIZE))
+            modules = []
 
         # If we still have modules, write them
         if modules or skip_main_bundle:
-            bundles[self.write_bundle('main', modules)] = [m.id for m in modules]
+            members.append(('main', modules))
+
+        # Write every bundle in dependency order, so they are the same on every machine
+        members = [(name, sort_by_dependencies(bundle_modules)) for name, bundle_modules in members]
+        modules = sort_by_dependencies(modules)
+
+        start = time.time()
+        self.reused_bundles = []
+        bundles = OrderedDict()
+        for path, (name, bundle_modules) in zip(self.write_bundles(members), members):
+            bundles[path] = [m.id for m in bundle_modules]
+        send_phase_finished(self.__class__, 'bundles', time.time() - start, bundles=len(members),
+                            bundles_written=len(members) - len(self.reused_bundles),
+                            bundles_reused=len(self.reused_bundles))
 
         return bundles, modules
 
+    def get_module_size(self, module):
+        return os.path.getsize(self.finder.get_module_path(module.location))
+
+    def write_bundles(self, members):
+        """
+        Write a list of (basename, modules) bundles, in parallel when configured with ``REQUIREJS_BUNDLE_WORKERS``.
+
+        The storage is asked for the existing bundles once, by listing the output directory. New bundles are saved
+        in the background by ``REQUIREJS_UPLOAD_WORKERS`` threads, if configured.
+
+        Returns the bundle urls in the same order.
+        """
+        writer = self.get_bundle_writer()
+        self.existing_bundles = writer.get_existing_paths()
+        if UPLOAD_WORKERS and UPLOAD_WORKERS > 1:
+            self.uploads = UploadQueue(writer.storage, UPLOAD_WORKERS)
+        try:
+            if not BUNDLE_WORKERS or BUNDLE_WORKERS < 2 or len(members) < 2:
+                return [self.write_bundle(name, modules) for name, modules in members]
+
+            pool = ThreadPool(min(BUNDLE_WORKERS, len(members)))
+            try:
+                return pool.map(lambda member: self.write_bundle(*member), members)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            self.finder.save_cache()
+            if self.uploads is not None:
+                self.uploads.join()
+            self.existing_bundles = None
+            self.uploads = None
+
     @staticmethod
     def get_default_config():
         """
@@ -1,18 +1,32 @@
 import os
 import re
+import fnmatch
+import hashlib
+import threading
+import time
+from contextlib import contextmanager
 from itertools import chain
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from multiprocessing.pool import ThreadPool
 
+from .scanner import scan
+from .signals import send_phase_finished
 from .utils import is_app_installed
 
 
 require_pattern = re.compile(r'(?:;|\s|>|^)require\s*\(\s*?(\[[^\]]*\])')
-define_pattern = re.compile(r'(?:;|\s|>|^)define\s*\(\s*?(\[[^\]]*\])')
-define_noargs_pattern = re.compile(r'(?:;|\s|>|^)define\s*\(\s*?function')
-define_named_pattern = re.compile(r'(?:;|\s|>|^)define\s*\(\s*?(?:((?:"[^"]*")|(?:\'[^\']*\'))\s*?,\s*?)(\[[^\]]*\])?')
 
 Module = namedtuple('Module', ['id', 'location', 'dependencies', 'named'])
 
+# What a module file holds: its dependencies, the ids it defines (None for anonymous defines) and the offsets, in
+# bytes, where the id needs to be spliced into unnamed define() calls when bundling it.
+ModuleInfo = namedtuple('ModuleInfo', ['dependencies', 'defined', 'splices'])
+
+# Leaf modules are not scanned, but only searched for define() calls, like the ones in minified builds and UMD
+# wrappers, which do not need to follow a space or semicolon. A define() call with a quoted name first is named.
+leaf_define_pattern = re.compile(br'(?<![\w$.])define\s*\(')
+leaf_name_pattern = re.compile(br'''\s*("[^"\n]*"|'[^'\n]*')\s*,''')
+
 
 class ModuleFinder(object):
     """
@@ -20,58 +34,318 @@ class ModuleFinder(object):
     """
 
     def __init__(self, template_directories, static_finder,
-                 app_alias=None, starting_dependencies=None, aliases=None):
+                 app_alias=None, starting_dependencies=None, aliases=None, cache=None, workers=None,
+                 charset='utf-8', static_index=False, watcher=None,
+                 leaf_patterns=None, leaf_size=None, leaf_line_length=None, template_include=None,
+                 template_exclude=None):
         self.template_directories = template_directories
         self.static_finder = static_finder
         self.app_alias = app_alias
         self.starting_dependencies = starting_dependencies
         self.aliases = aliases
+        self.cache = cache
+        self.workers = workers
+        self.charset = charset
+        self.static_index = static_index
+        self.watcher = watcher
+        self.leaf_patterns = leaf_patterns
+        self.leaf_size = leaf_size
+        self.leaf_line_length = leaf_line_length
+        self.template_include = template_include
+        self.template_exclude = template_exclude
+        self.pool = None
+        self.module_info = {}
+        self.module_digests = {}
+        self.template_info = {}
+        self.module_paths = {}
+        self.template_entries = None
+        self.template_count = 0
+        self.static_paths = None
+        self._modules = None
+        self._indexes = None
+        self.stats = dict.fromkeys(['templates_read', 'templates_cached', 'modules_read', 'modules_cached'], 0)
+        self.stats_lock = threading.Lock()
+        # Guards finding modules when the finder is shared between threads, like when it is watched
+        self.lock = threading.RLock()
+        # Bumped whenever files changed, so anything derived from the found modules can tell it is outdated
+        self.version = 0
+        # Per thread, whether refreshing is held off until the end of a refreshed() block
+        self.local = threading.local()
 
     #
-    # File discovery
+    # Modules
     #
 
     @property
     def modules(self):
         """
         Main function to query for modules in Django project
+
+        Modules are only found once, until the finder is invalidated or, when watched, files changed.
+        """
+        with self.lock:
+            self.refresh()
+            if self._modules is None:
+                self._modules = self.find_modules()
+                self.watch()
+            return list(self._modules)
+
+    def find_modules(self):
+        # Count what is read for this run only
+        with self.stats_lock:
+            self.stats = dict.fromkeys(self.stats, 0)
+
+        if self.workers and self.workers > 1:
+            self.pool = ThreadPool(self.workers)
+        try:
+            start = time.time()
+            starting_modules = sorted(self.get_template_dependencies())
+            send_phase_finished(
+                self.__class__, 'templates', time.time() - start, templates=self.template_count,
+                templates_read=self.stats['templates_read'], templates_cached=self.stats['templates_cached'])
+
+            if self.starting_dependencies:
+                starting_modules = chain(self.starting_dependencies, starting_modules)
+
+            start = time.time()
+            modules = self.get_modules_from(starting_modules)
+            send_phase_finished(
+                self.__class__, 'modules', time.time() - start, modules=len(modules),
+                modules_read=self.stats['modules_read'], modules_cached=self.stats['modules_cached'])
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+
+        if self.cache is not None:
+            self.cache.save()
+        return modules
+
+    def invalidate(self):
+        """
+        Forget everything found, so modules will be found again on the next access. Files which did not change are
+        still taken from the graph cache, if there is one.
+        """
+        self._modules = None
+        self._indexes = None
+        self.template_entries = None
+        self.template_info = {}
+        self.module_info = {}
+        self.module_digests = {}
+        self.module_paths = {}
+        self.static_paths = None
+        self.version += 1
+
+    #
+    # Watching files
+    #
+
+    def watch(self):
+        """
+        Let the watcher, if any, watch the template directories and the module files found.
+        """
+        if self.watcher is not None:
+            self.watcher.watch_directories(self.template_directories)
+            self.watcher.watch_files([path for path in self.module_paths.values() if path])
+
+    def refresh(self):
+        """
+        Update the finder with the files the watcher saw changing since the last refresh, and with the files of
+        modules which could not be found before and now exist, which the watcher does not know about.
+        """
+        if self.watcher is not None and not getattr(self.local, 'refreshed', False):
+            with self.lock:
+                changes = self.watcher.get_changes() | self.get_appeared_paths()
+                if changes:
+                    self.update(changes)
+
+    @contextmanager
+    def refreshed(self):
+        """
+        Refresh once, and not again for everything this thread asks the finder within the block, like while
+        rendering a single RequireJS tag.
+        """
+        self.refresh()
+        refreshed = getattr(self.local, 'refreshed', False)
+        self.local.refreshed = True
+        try:
+            yield self
+        finally:
+            self.local.refreshed = refreshed
+
+    def get_appeared_paths(self):
+        """
+        Look for the files of the module ids which could not be found, asking the static finder directly since an
+        index of static files would be outdated.
+        """
+        paths = set()
+        for module_id, path in list(self.module_paths.items()):
+            if path is None:
+                paths.update(p for p in map(self.static_finder.find, self.get_static_names(module_id)) if p)
+        return paths
+
+    def update(self, paths):
+        """
+        Forget what was found in the given changed, added or removed files only.
+
+        Modules will be found again on the next access, but only these files are read again; everything else is
+        taken from memory.
+        """
+        with self.lock:
+            known_paths = set(self.module_paths.values())
+            for path in paths:
+                if self.get_template_name(path) != path:
+                    self.template_info.pop(path, None)
+                    self.template_entries = None
+                else:
+                    self.module_info.pop(path, None)
+                    self.module_digests.pop(path, None)
+                    if path not in known_paths or not os.path.exists(path):
+                        # Module ids might resolve to other files now
+                        self.module_paths = {}
+                        self.static_paths = None
+            self._modules = None
+            self._indexes = None
+            self.version += 1
+
+    #
+    # Indexes on found modules
+    #
+
+    def get_indexes(self):
+        with self.lock, self.refreshed():
+            if self._indexes is None:
+                by_id, by_location, dependents = {}, OrderedDict(), {}
+                for module in self.modules:
+                    by_id.setdefault(module.id, module)
+                    by_location.setdefault(module.location, []).append(module)
+                    for dependency in set(self.get_module_name(d) for d in module.dependencies):
+                        dependents.setdefault(dependency, []).append(module)
+                self._indexes = by_id, by_location, dependents
+            return self._indexes
+
+    def get_module(self, module_id):
+        """
+        Get the found module with the given id, or None.
         """
-        starting_modules = self.get_template_dependencies()
-        if self.starting_dependencies:
-            starting_modules = chain(self.starting_dependencies, starting_modules)
+        return self.get_indexes()[0].get(module_id)
 
-        return self.get_modules_from(starting_modules)
+    def get_modules_at(self, location):
+        """
+        Get the found modules defined in the file at the given location, which is the module id of the file.
+        """
+        return list(self.get_indexes()[1].get(location, []))
+
+    def get_dependents(self, module_id):
+        """
+        Get the found modules depending on the module with the given id.
+        """
+        return list(self.get_indexes()[2].get(module_id, []))
+
+    def get_template_modules(self, template_name):
+        """
+        Get all modules needed by the template with the given name, as in the keys of ``get_template_entries()``.
+        """
+        return self.get_modules_from(self.get_template_entries().get(template_name, []))
+
+    #
+    # File discovery
+    #
 
     def get_template_files(self):
         """
         Quick and simple template discovery for TEMPLATE_DIRS and app-based template dirs
+
+        Template directories inside other template directories are walked once. Only files matching the include
+        patterns, if any, and none of the exclude patterns are returned.
         """
         template_files = []
+        walked = []
         for template_dir in self.template_directories:
+            template_dir = os.path.normpath(template_dir)
+            if any(self.is_inside(template_dir, d) for d in walked):
+                continue
             for directory, dir_names, file_names in os.walk(template_dir):
+                # Skip directories walked before
+                dir_names[:] = [d for d in dir_names if os.path.join(directory, d) not in walked]
                 for filename in file_names:
-                    template_files.append(os.path.join(directory, filename))
+                    path = os.path.join(directory, filename)
+                    if self.is_template(os.path.relpath(path, template_dir).replace(os.sep, '/')):
+                        template_files.append(path)
+            walked.append(template_dir)
         return template_files
 
+    def is_template(self, name):
+        if self.template_include and not any(fnmatch.fnmatchcase(name, p) for p in self.template_include):
+            return False
+        if self.template_exclude and any(fnmatch.fnmatchcase(name, p) for p in self.template_exclude):
+            return False
+        return True
+
+    @staticmethod
+    def is_inside(path, directory):
+        return path == directory or path.startswith(os.path.join(directory, ''))
+
     def get_module_path(self, module_id):
         """
         Locate a static file for a RequireJS module name.
+
+        Every module name is resolved once, modules which cannot be found included.
         """
-        # Check if we have an alias for this module
-        if self.aliases and module_id in self.aliases:
-            module_id = self.aliases[module_id]
+        if module_id in self.module_paths:
+            return self.module_paths[module_id]
 
-        module_js = '{}.js'.format(module_id)
+        path = None
+        for name in self.get_static_names(module_id):
+            path = self.find_static(name)
+            if path is not None:
+                break
 
-        path = self.static_finder.find(module_js)
+        self.module_paths[module_id] = path
+        return path
+
+    def get_static_names(self, module_id):
+        """
+        Get the static file names a RequireJS module name could be found at, in order.
+        """
+        # Check if we have an alias for this module
+        name = self.aliases[module_id] if self.aliases and module_id in self.aliases else module_id
+
+        module_js = '{}.js'.format(name)
+        names = [module_js]
 
         # Check for app alias if we cannot find it
         module_parts = module_js.split('/')
-        if path is None and self.app_alias and is_app_installed(module_parts[0]):
+        if self.app_alias and is_app_installed(module_parts[0]):
             module_parts.insert(1, self.app_alias)
-            path = self.static_finder.find('/'.join(module_parts))
+            names.append('/'.join(module_parts))
+        return names
 
-        return path
+    def find_static(self, path):
+        """
+        Find a static file, either through the static finder or in the index of all static Javascript files.
+        """
+        if self.static_paths is None:
+            self.static_paths = self.get_static_index() if self.static_index else {}
+
+        if path not in self.static_paths:
+            self.static_paths[path] = None if self.static_index else self.static_finder.find(path)
+        return self.static_paths[path]
+
+    def get_static_index(self):
+        """
+        List the Javascript files of all static finders, mapping their paths to their location on disk. Like with
+        finding a single file, the first finder listing a path wins.
+        """
+        index = {}
+        for finder in self.static_finder.get_finders():
+            for path, storage in finder.list([]):
+                if path.endswith('.js'):
+                    prefix = getattr(storage, 'prefix', None)
+                    name = os.path.join(prefix, path) if prefix else path
+                    index.setdefault(name.replace(os.sep, '/'), storage.path(path))
+        return index
 
     #
     # Module discovery
@@ -86,29 +360,156 @@ class ModuleFinder(object):
         path = self.get_module_path(module_id)
 
         if path is not None:
-            content = self.get_module_content(path)
-            return self.extract_modules(module_id, content)
+            if path not in self.module_info and self.is_leaf(module_id, path):
+                self.module_info[path] = self.get_leaf_info(path)
+            info = self.get_module_info(path)
+            return self.create_modules(module_id, info.dependencies, info.defined)
 
         return []
 
-    def extract_modules(self, module_id, content):
-        dependencies = []
-        # First, find declared require-dependencies
-        for match in require_pattern.findall(content):
-            dependencies.extend(self.get_dependencies_from_match(match))
+    def is_leaf(self, module_id, path):
+        """
+        Check whether a module should be taken as it is, without scanning it for dependencies. These are the
+        modules matching one of the leaf patterns, files of at least the leaf size and, when a leaf line length is
+        set, minified files.
+        """
+        if self.leaf_patterns and any(fnmatch.fnmatchcase(module_id, p) for p in self.leaf_patterns):
+            return True
+        if self.leaf_size and os.path.getsize(path) >= self.leaf_size:
+            return True
+        if self.leaf_line_length:
+            # Minified files have long lines, which we expect to find near the start
+            with open(path, 'rb') as f:
+                sample = f.read(self.leaf_line_length * 4)
+            return any(len(line) > self.leaf_line_length for line in sample.split(b'\n'))
+        return False
+
+    def get_leaf_info(self, path):
+        """
+        Get the ModuleInfo of a leaf module file, without dependencies. The file is only searched for define()
+        calls, and not at all when it is found unchanged in the cache. A file without them is no module at all.
+        """
+        cached = self.cache.get('leaves', path) if self.cache is not None else None
+        if cached is not None:
+            self.count('modules_cached')
+            return ModuleInfo(*cached)
+
+        with open(path, 'rb') as f:
+            content = f.read()
+        defined, splices = [], []
+        for call in leaf_define_pattern.finditer(content):
+            name = leaf_name_pattern.match(content, call.end())
+            if name is not None:
+                defined.append(name.group(1)[1:-1].strip().decode(self.charset))
+            else:
+                splices.append(call.end())
+                if None not in defined:
+                    defined.append(None)
+        info = ModuleInfo([], defined, splices)
+        if self.cache is not None:
+            self.cache.set('leaves', path, info)
+        self.count('modules_read')
+        return info
+
+    def get_module_info(self, path):
+        """
+        Get the ModuleInfo of the module file at path. Every file is parsed once, and not at all when it is
+        found unchanged in the cache.
+        """
+        info = self.module_info.get(path)
+        if info is None:
+            cached = self.cache.get('modules', path) if self.cache is not None else None
+            if cached is None:
+                info = self.parse_module(self.get_module_content(path))
+                if self.cache is not None:
+                    self.cache.set('modules', path, info)
+                self.count('modules_read')
+            else:
+                info = ModuleInfo(*cached)
+                self.count('modules_cached')
+            self.module_info[path] = info
+        return info
+
+    def get_module_digest(self, path):
+        """
+        Get the md5 hex digest of the module file at path.
 
-        # Second, extract all dependencies in define-calls
-        for match in define_pattern.findall(content):
-            dependencies.extend(self.get_dependencies_from_match(match))
+        When the finder is watched, every file is hashed once, and again only when it changed. Otherwise, the file
+        is only hashed when it is not found unchanged in the cache, since changes would go unnoticed in memory.
+        """
+        digest = self.module_digests.get(path)
+        if digest is None:
+            digest = self.cache.get('digests', path) if self.cache is not None else None
+            if digest is None:
+                with open(path, 'rb') as f:
+                    digest = hashlib.md5(f.read()).hexdigest()
+                if self.cache is not None:
+                    self.cache.set('digests', path, digest)
+            if self.watcher is not None:
+                self.module_digests[path] = digest
+        return digest
+
+    def save_cache(self):
+        """
+        Persist what was added to the cache since modules were found, like the digests of bundled modules.
+        """
+        if self.cache is not None:
+            self.cache.save()
 
-        # Convert the define calls into modules
-        for _ in chain(define_pattern.findall(content), define_noargs_pattern.findall(content)):
-            yield Module(id=module_id, location=module_id, dependencies=dependencies, named=False)
+    def extract_modules(self, module_id, content):
+        info = self.parse_module(content)
+        return self.create_modules(module_id, info.dependencies, info.defined)
 
-        # Named modules get special treatment
-        for match in define_named_pattern.findall(content):
-            defined_id = match[0][1:-1].strip()
-            yield Module(id=defined_id, location=module_id, dependencies=dependencies, named=True)
+    @staticmethod
+    def create_modules(module_id, dependencies, defined):
+        """
+        Convert the defined names of a module file into modules. Anonymous defines are named None.
+        """
+        for defined_id in defined:
+            if defined_id is None:
+                yield Module(id=module_id, location=module_id, dependencies=dependencies, named=False)
+            else:
+                yield Module(id=defined_id, location=module_id, dependencies=dependencies, named=True)
+
+    def parse_module(self, content):
+        """
+        Find the dependencies, the defined modules and the define() calls to rewrite in the content of a module file.
+        """
+        dependencies = []
+        defined = []
+        splices = []
+        for call in scan(content):
+            if call.dependencies:
+                dependencies.extend(self.get_dependencies_from_match(call.dependencies))
+
+            if call.function == 'define':
+                if call.name is not None:
+                    # Named modules get special treatment
+                    defined.append(call.name)
+                else:
+                    splices.append(call.offset)
+                    if call.dependencies or call.factory:
+                        defined.append(None)
+
+        return ModuleInfo(dependencies, defined, self.get_byte_offsets(content, splices))
+
+    def get_byte_offsets(self, content, offsets):
+        """
+        Convert offsets in the decoded content to offsets in the file, which differ after non-ASCII characters.
+        """
+        byte_offsets = []
+        position = byte_position = 0
+        for offset in offsets:
+            byte_position += len(content[position:offset].encode(self.charset))
+            position = offset
+            byte_offsets.append(byte_position)
+        return byte_offsets
+
+    def get_dependencies(self, content):
+        """
+        Get the dependencies of all require() and define() calls in content.
+        """
+        return self.parse_module(content).dependencies
 
     #
     # Dependency discovery
@@ -119,32 +520,105 @@ class ModuleFinder(object):
         Walk through templates defined in the project and find require() calls
         """
         dependencies = set()
-        for template in self.get_template_files():
-            with open(template, 'r') as f:
-                for match in require_pattern.findall(f.read()):
-                    dependencies.update(self.get_dependencies_from_match(match))
+        for info in self.get_template_entries().values():
+            dependencies.update(info)
         return dependencies
 
-    def get_modules_from(self, module_ids, known=None):
+    def get_template_entries(self):
+        """
+        Map the templates calling require() to their dependencies, by the name of the template relative to its
+        template directory. Templates with the same name in different directories are merged.
+        """
+        if self.template_entries is None:
+            template_files = self.get_template_files()
+            self.template_count = len(template_files)
+            entries = OrderedDict()
+            for path, info in zip(template_files, self.map(self.get_template_info, template_files)):
+                if info:
+                    entries.setdefault(self.get_template_name(path), []).extend(info)
+            self.template_entries = entries
+        return self.template_entries
+
+    def get_template_name(self, path):
+        for template_dir in self.template_directories:
+            if path.startswith(os.path.join(template_dir, '')):
+                return os.path.relpath(path, template_dir).replace(os.sep, '/')
+        return path
+
+    def get_template_info(self, path):
         """
-        Recursively walk through modules and find their dependencies.
+        Get the require() dependencies of a single template, using the cache if possible.
+        """
+        if path in self.template_info:
+            return self.template_info[path]
+
+        info = self.cache.get('templates', path) if self.cache is not None else None
+        if info is None:
+            info = []
+            with open(path, 'rb') as f:
+                content = f.read()
+            # Most templates do not call require() at all, so check that before decoding and matching
+            if b'require' in content:
+                for match in require_pattern.findall(content.decode(self.charset, 'replace')):
+                    info.extend(self.get_dependencies_from_match(match))
+            if self.cache is not None:
+                self.cache.set('templates', path, info)
+            self.count('templates_read')
+        else:
+            self.count('templates_cached')
+        self.template_info[path] = info
+        return info
+
+    def get_modules_from(self, module_ids, known=None):
         """
-        if known is None:
-            known = []
-        known_ids = [m.id for m in known]
+        Walk through modules and find their dependencies.
 
-        for module_id in [m_id for m_id in module_ids if m_id not in known_ids]:
-            modules = list(self.get_modules_from_id(module_id))
-            known.extend(modules)  # TODO: filter out doubles
-            for module in modules:
-                # Fetch all module's dependencies
-                self.get_modules_from(module.dependencies, known=known)
-        return known
+        The graph is traversed breadth first, one wave of dependencies at a time, so the modules are returned in a
+        deterministic order. Every module is returned once, even when its file defines it more than once.
+        """
+        found = OrderedDict(((m.id, m.location), m) for m in known or [])
+        found_ids = set(m.id for m in found.values())
+        seen = set()
+
+        wave = module_ids
+        while True:
+            # Only look up modules we did not see or find yet
+            unseen_ids = []
+            for module_id in wave:
+                name = self.get_module_name(module_id)
+                if module_id not in found_ids and name not in seen:
+                    seen.add(name)
+                    unseen_ids.append(module_id)
+            if not unseen_ids:
+                break
+
+            # Read and parse the modules in this wave, in parallel if we have a pool
+            wave = []
+            for module in chain.from_iterable(self.map(self.get_modules_from_id, unseen_ids)):
+                key = (module.id, module.location)
+                if key not in found:
+                    found[key] = module
+                    found_ids.add(module.id)
+                    wave.extend(module.dependencies)
+
+        return list(found.values())
 
     #
     # Helpers
     #
 
+    def map(self, func, items):
+        """
+        Apply func to all items, using the worker pool when scanning with multiple workers.
+        """
+        if self.pool is None:
+            return [func(item) for item in items]
+        return self.pool.map(func, items)
+
+    def count(self, stat):
+        with self.stats_lock:
+            self.stats[stat] += 1
+
     @staticmethod
     def get_module_name(name):
         """
@@ -152,10 +626,9 @@ class ModuleFinder(object):
         """
         return name.split('!')[0]
 
-    @staticmethod
-    def get_module_content(path):
-        with open(path, 'r') as f:
-            return f.read()
+    def get_module_content(self, path):
+        with open(path, 'rb') as f:
+            return f.read().decode(self.charset)
 
     @staticmethod
     def get_dependencies_from_match(match):
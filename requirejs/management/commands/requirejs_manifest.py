@@ -0,0 +1,38 @@
+import django
+from django.core.management.base import BaseCommand, CommandError
+
+# noinspection PyPackageRequirements
+from compressor.conf import settings
+
+from ...filter import RequireJSCompiler, MANIFEST
+from ...manifest import write_manifest
+
+
+class Command(BaseCommand):
+    help = "Find modules, write bundles and store the resulting RequireJS config in a manifest"
+    if django.VERSION < (1, 8):
+        # Positional arguments the optparse way, before Django knew add_arguments
+        args = '<data-main data-main ...>'
+
+    def add_arguments(self, parser):
+        parser.add_argument('data_main', nargs='*', metavar='data-main',
+                            help="data-main of a RequireJS tag to write bundles and a config for")
+
+    def handle(self, *args, **options):
+        data_mains = options.get('data_main', args)
+        if not MANIFEST:
+            raise CommandError('The manifest is currently disabled. Please set the REQUIREJS_MANIFEST setting '
+                               'to the name of the manifest file.')
+
+        manifest = {}
+        # Without a data-main, we still want the config for the plain RequireJS tag
+        for main in [''] + list(data_mains):
+            compiler = RequireJSCompiler('', attrs={'data-main': main})
+            config, main_bundle = compiler.get_require_config(forced=True)
+            manifest[main] = {'config': config, 'main_bundle': main_bundle}
+            self.stdout.write("Wrote {count} bundle(s) for data-main '{main}'".format(
+                count=len(config.get('bundles', {})), main=main))
+
+        write_manifest(MANIFEST, manifest)
+        self.stdout.write("Manifest written to {output_dir}/{name}".format(
+            output_dir=settings.COMPRESS_OUTPUT_DIR.strip('/'), name=MANIFEST))
@@ -0,0 +1,77 @@
+import os
+import json
+import logging
+import tempfile
+from collections import OrderedDict
+
+from django.core.files.base import ContentFile
+
+# noinspection PyPackageRequirements
+from compressor.conf import settings
+# noinspection PyPackageRequirements
+from compressor.storage import default_storage
+
+logger = logging.getLogger('requirejs')
+
+_manifest = None
+_manifest_version = 0
+_manifest_missing = False
+
+
+def get_manifest_filename(name):
+    return os.path.join(settings.COMPRESS_OUTPUT_DIR.strip('/'), name)
+
+
+def get_manifest(name):
+    """
+    Load the manifest written by the ``requirejs_manifest`` command, once per process.
+
+    Returns an empty manifest if it was not written (yet), in which case it is looked for again on the next call.
+    """
+    global _manifest, _manifest_version, _manifest_missing
+    if _manifest is None:
+        filename = get_manifest_filename(name)
+        if not default_storage.exists(filename):
+            if not _manifest_missing:
+                logger.warning("RequireJS manifest %s not found, finding modules instead", filename)
+                _manifest_missing = True
+            return {}
+        with default_storage.open(filename) as f:
+            _manifest = json.loads(f.read().decode('utf-8'), object_pairs_hook=OrderedDict)
+        _manifest_version += 1
+    return _manifest
+
+
+def write_manifest(name, manifest):
+    """
+    Write the manifest to compressor's storage, replacing the manifest which was there.
+
+    On the file system, the manifest is written next to the old one and moved over it, so other processes never
+    find it missing. Other storages cannot do that, and have the old manifest deleted first.
+    """
+    global _manifest, _manifest_version
+    filename = get_manifest_filename(name)
+    content = json.dumps(manifest).encode('utf-8')
+    try:
+        path = default_storage.path(filename)
+    except NotImplementedError:
+        if default_storage.exists(filename):
+            default_storage.delete(filename)
+        default_storage.save(filename, ContentFile(content))
+    else:
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.rename(temp_path, path)
+    _manifest = manifest
+    _manifest_version += 1
+
+
+def get_manifest_version():
+    """
+    Number which changes every time the manifest is loaded or written.
+    """
+    return _manifest_version
@@ -0,0 +1,68 @@
+import re
+from collections import namedtuple
+
+# One pass over the content finds comments, strings, template literals and require()/define() calls. Comments and
+# strings are only matched to skip over them, so calls inside them are not picked up.
+token_pattern = re.compile(r'''
+    //[^\n]*
+  | /\*.*?\*/
+  | "(?:[^"\\\n]|\\.)*"
+  | '(?:[^'\\\n]|\\.)*'
+  | `(?:[^`\\]|\\.)*`
+  | (?:(?<=[;\s>])|^)(require|define)\s*\(
+''', re.DOTALL | re.VERBOSE)
+
+call_pattern = re.compile(r'(?:(?<=[;\s>])|^)(?:require|define)\s*\(')
+
+# The arguments of a call: an optional name, an optional list of dependencies and an optional function
+arguments_pattern = re.compile(r'''
+    \s*(?:("[^"]*"|'[^']*')\s*,)?
+    \s*(\[[^\]]*\])?
+    \s*,?\s*(function)?
+''', re.VERBOSE)
+
+Call = namedtuple('Call', ['function', 'name', 'dependencies', 'offset', 'factory'])
+
+
+def scan(content):
+    """
+    Find all require() and define() calls in Javascript content.
+
+    Every call records the name it defines (for named defines), the source of its dependency list, the offset
+    just after its opening parenthesis, and whether a function follows directly.
+    """
+    calls = []
+    position = 0
+    while True:
+        token = token_pattern.search(content, position)
+        if token is None:
+            break
+        position = token.end()
+        function = token.group(1)
+        if function is None:
+            if content[token.start()] in '"\'`' and is_unbalanced(content, token):
+                # Skip just the quote, which is probably part of a regular expression
+                position = token.start() + 1
+            continue  # Comment or string
+
+        offset = token.end()
+        name, dependencies, factory = arguments_pattern.match(content, offset).groups()
+        calls.append(Call(
+            function=function,
+            name=name[1:-1].strip() if name else None,
+            dependencies=dependencies,
+            offset=offset,
+            factory=factory is not None,
+        ))
+    return calls
+
+
+def is_unbalanced(content, string):
+    """
+    Check whether a string token ends within the arguments of a call inside it, which means its opening quote was
+    not opening a string at all, like the quote in ``/'/``, and its closing quote was opening one.
+    """
+    for call in call_pattern.finditer(content, string.start() + 1, string.end() - 1):
+        if arguments_pattern.match(content, call.end()).end() >= string.end():
+            return True
+    return False
@@ -0,0 +1,37 @@
+import logging
+
+import django.dispatch
+
+logger = logging.getLogger('requirejs')
+
+# Sent when a phase of finding modules or generating the config is done. ``stats`` is a dict of counts for that run
+# only, which depend on the phase:
+#  - ``templates``: ``templates`` (all template files, whether they call require() or not), ``templates_read`` and
+#    ``templates_cached``
+#  - ``modules``: ``modules``, ``modules_read`` and ``modules_cached``
+#  - ``bundles``: ``bundles``, ``bundles_written`` and ``bundles_reused``
+#  - ``config``: ``manifest`` (1 if the config came from the manifest, 0 otherwise)
+phase_finished = django.dispatch.Signal(providing_args=['phase', 'duration', 'stats'])
+
+# Sent for every bundle, with the ``name`` and ``path`` of the bundle and the number of ``modules`` in it. Bundles
+# which are ``reused`` from an earlier run have their sizes and ``filter_time`` set to None.
+bundle_written = django.dispatch.Signal(providing_args=[
+    'name', 'path', 'modules', 'reused', 'input_size', 'output_size', 'filter_time'])
+
+
+def send_phase_finished(sender, phase, duration, **stats):
+    phase_finished.send(sender=sender, phase=phase, duration=duration, stats=stats)
+    logger.info("%s finished in %.3fs", phase, duration, extra={
+        'requirejs': {'event': 'phase_finished', 'phase': phase, 'duration': duration, 'stats': stats}
+    })
+
+
+def send_bundle_written(sender, name, path, modules, reused, input_size=None, output_size=None, filter_time=None):
+    bundle_written.send(sender=sender, name=name, path=path, modules=modules, reused=reused,
+                        input_size=input_size, output_size=output_size, filter_time=filter_time)
+    logger.info("bundle %s %s", name, 'reused' if reused else 'written', extra={
+        'requirejs': {
+            'event': 'bundle_written', 'name': name, 'path': path, 'modules': modules, 'reused': reused,
+            'input_size': input_size, 'output_size': output_size, 'filter_time': filter_time,
+        }
+    })
@@ -0,0 +1,115 @@
+import re
+import json
+
+BASE64_DIGITS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+
+newline_pattern = re.compile(b'\n')
+
+
+class IndexSourceMap(object):
+    """
+    Index source map for a bundle, with a section per module, built while the bundle is written.
+
+    Modules copied from their source are mapped line by line, taking the text inserted into them, like the module id
+    spliced into define() calls, into account. Filtered modules are only mapped from their start.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.sections = []
+        self.line = 0  # Line in the bundle the current module starts on
+        self.source = None
+        self.lines = 0
+        self.column = 0
+        self.inserts = []
+
+    def start(self, source):
+        """
+        Start a module copied from source, or from nowhere in particular when source is None.
+        """
+        self.source = source
+        self.lines = 0
+        self.column = 0
+        self.inserts = []
+
+    def add(self, piece, inserted=False):
+        """
+        Add a piece of the module, as bytes. Inserted pieces are not part of the source, and cannot contain newlines.
+        """
+        if inserted:
+            self.inserts.append((self.lines, self.column, len(piece)))
+            self.column += len(piece)
+            return
+
+        newlines = piece.count(b'\n') if isinstance(piece, bytes) else sum(1 for _ in newline_pattern.finditer(piece))
+        if newlines:
+            self.lines += newlines
+            self.column = len(piece) - piece.rfind(b'\n') - 1
+        else:
+            self.column += len(piece)
+
+    def end(self):
+        """
+        Finish the module, so the next one starts on the next line.
+        """
+        if self.source is not None:
+            segments = [[(0, line, 0)] for line in range(self.lines + 1)]
+            shift, shifted_line = 0, None
+            for line, column, length in self.inserts:
+                if line != shifted_line:
+                    shift, shifted_line = 0, line
+                # Text after the insert is where it was before, in the source
+                segments[line].append((column + length, line, column - shift))
+                shift += length
+            self.add_section(self.source, segments)
+        self.line += self.lines + 1
+
+    def add_filtered(self, source, output):
+        """
+        Add a filtered module, of which only the start can be mapped to its source, if any.
+        """
+        if source is not None:
+            self.add_section(source, [[(0, 0, 0)]])
+        self.line += output.count('\n') + 1
+
+    def add_section(self, source, segments):
+        self.sections.append({
+            'offset': {'line': self.line, 'column': 0},
+            'map': {'version': 3, 'sources': [source], 'names': [], 'mappings': encode_mappings(segments)},
+        })
+
+    def to_json(self):
+        return json.dumps({'version': 3, 'file': self.filename, 'sections': self.sections})
+
+
+def encode_mappings(lines):
+    """
+    Encode a list of lines with (generated column, source line, source column) segments into source map mappings,
+    for a map with a single source.
+    """
+    encoded_lines = []
+    source_line = source_column = 0
+    for segments in lines:
+        encoded_segments = []
+        column = 0
+        for generated_column, line, line_column in segments:
+            encoded_segments.append(''.join([
+                encode_vlq(generated_column - column), encode_vlq(0),
+                encode_vlq(line - source_line), encode_vlq(line_column - source_column),
+            ]))
+            column, source_line, source_column = generated_column, line, line_column
+        encoded_lines.append(','.join(encoded_segments))
+    return ';'.join(encoded_lines)
+
+
+def encode_vlq(value):
+    value = ((-value) << 1) | 1 if value < 0 else value << 1
+    encoded = ''
+    while True:
+        digit = value & 31
+        value >>= 5
+        if value:
+            digit |= 32
+        encoded += BASE64_DIGITS[digit]
+        if not value:
+            return encoded
@@ -1,17 +1,99 @@
+import gzip
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
 import django
 import unittest
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
 from django.test import SimpleTestCase
+from django.utils.six import StringIO
 
 # We need to set up a few settings to make sure django-compressor loads
-settings.configure(STATIC_ROOT='/tmp/', STATIC_URL='/')
+settings.configure(STATIC_ROOT='/tmp/', STATIC_URL='/', INSTALLED_APPS=['requirejs'],
+                   USE_I18N=False)
 
 if django.VERSION >= (1, 7):
     django.setup()
 
-from requirejs.finder import ModuleFinder
+from django.contrib.staticfiles.finders import FileSystemFinder
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+
+from compressor.cache import cache
+from compressor.conf import settings as compressor_settings
+
+from requirejs.bundling import get_clusters, pack_by_size, sort_by_dependencies, split_by_entries
+from requirejs.cache import FileFilterCache, FileGraphCache, LRUCache
+from requirejs.finder import Module, ModuleFinder
+from requirejs import filter as filter_module, manifest
 from requirejs.filter import RequireJSCompiler
+from requirejs.management.commands import requirejs_manifest
+from requirejs.signals import bundle_written, phase_finished
+from requirejs.watcher import InotifyWatcher, PollingWatcher, inotify_simple
+from requirejs.writer import BundleWriter, brotli
+
+
+class DirectoryFinder(object):
+    """
+    Stand-in for the staticfiles finders, finding files in a single directory.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.found = []
+
+    def find(self, path):
+        self.found.append(path)
+        path = os.path.join(self.root, path)
+        return path if os.path.exists(path) else None
+
+    def get_finders(self):
+        return [FileSystemFinder()]
+
+
+def clear_output():
+    """
+    Remove the bundles written by earlier tests, which would otherwise be reused.
+    """
+    cache.clear()
+    shutil.rmtree(os.path.join(compressor_settings.COMPRESS_ROOT, compressor_settings.COMPRESS_OUTPUT_DIR),
+                  ignore_errors=True)
+
+
+class ProjectTestCase(SimpleTestCase):
+    """
+    Test case with a temporary project on disk, containing a template and static directory.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.template_dir = os.path.join(self.root, 'templates')
+        self.static_dir = os.path.join(self.root, 'static')
+        os.makedirs(self.template_dir)
+        os.makedirs(self.static_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, directory, name, content):
+        path = os.path.join(directory, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def get_finder(self, **kwargs):
+        return ModuleFinder([self.template_dir], DirectoryFinder(self.static_dir), **kwargs)
 
 
 class RequireDiscoverTests(SimpleTestCase):
@@ -160,6 +242,44 @@ class DefineDiscoverTests(RequireDiscoverTests):
     pattern_call = 'define'
 
 
+class ScannerTests(SimpleTestCase):
+    finder = ModuleFinder(tuple(), None)
+
+    def test_comments_and_strings(self):
+        info = self.finder.parse_module("""
+        // require(['commented']);
+        /* define(['block'], function() {}); */
+        var s = "require(['string'])";
+        define(['dep'], function() {});
+        """)
+        self.assertListEqual(['dep'], info.dependencies)
+        self.assertListEqual([None], info.defined)
+
+    def test_template_literals(self):
+        info = self.finder.parse_module("""
+        var s = `it's ${"a"} require(['template'])
+        over lines`; define(['a'], function() {});
+        """)
+        self.assertListEqual(['a'], info.dependencies)
+
+    def test_unbalanced_quotes(self):
+        for content in [
+            "var r = /'/g; define(['a'], function() {});",
+            'var r = /"/g; require([\'a\']);',
+            "var r = /`/g; define(['a'], function() {});",
+        ]:
+            info = self.finder.parse_module(content)
+            self.assertListEqual(['a'], info.dependencies, content)
+
+    def test_named_and_anonymous(self):
+        content = """define('named', ['named_dep'], function() {});
+        define(function() {});"""
+        info = self.finder.parse_module(content)
+        self.assertListEqual(['named_dep'], info.dependencies)
+        self.assertListEqual(['named', None], info.defined)
+        self.assertListEqual([content.rindex('(function') + 1], info.splices)
+
+
 class BundleTests(SimpleTestCase):
     compiler = RequireJSCompiler('')
 
@@ -169,7 +289,8 @@ class BundleTests(SimpleTestCase):
             return new Dep().test();
         });
         """
-        bundle = self.compiler.get_bundle_content('dep', content)
+        module = Module(id='dep', location='dep', dependencies=['other/dep'], named=False)
+        bundle = self.compiler.get_bundle_content(module, content)
         self.assertEqual(bundle, """
         define("dep", ['other/dep'], function(Dep) {
             return new Dep().test();
@@ -182,9 +303,859 @@ class BundleTests(SimpleTestCase):
             return new Dep().test();
         }
         """
-        bundle = self.compiler.get_bundle_content('dep', content)
+        module = Module(id='dep', location='dep', dependencies=[], named=False)
+        bundle = self.compiler.get_bundle_content(module, content)
         self.assertEqual(bundle, None)
 
 
+class BundleChunkTests(ProjectTestCase):
+
+    def setUp(self):
+        super(BundleChunkTests, self).setUp()
+        self.write(self.static_dir, 'app.js', "// \u00e9t\u00e9\ndefine(['named'], function() {});")
+        self.write(self.static_dir, 'named.js', "define('named', function() { return '\u00e9t\u00e9'; });")
+        self.compiler = RequireJSCompiler('')
+        self.compiler.finder = self.get_finder(starting_dependencies=['app'])
+        self.expected = [
+            "// \u00e9t\u00e9\ndefine(\"app\", ['named'], function() {});",
+            "define('named', function() { return '\u00e9t\u00e9'; });",
+        ]
+
+    def test_bundle_module(self):
+        for module, expected in zip(self.compiler.finder.modules, self.expected):
+            self.assertEqual(expected, self.compiler.get_bundle_module(module))
+
+    def test_streamed_and_decoded(self):
+        modules = self.compiler.finder.modules
+        with self.settings(COMPRESS_JS_FILTERS=[]):
+            writer = BundleWriter()
+            path = writer.write((self.compiler.get_bundle_chunks(m) for m in modules), 'chunks.js')
+        with writer.storage.open(path) as f:
+            self.assertEqual('\n'.join(self.expected), f.read().decode('utf-8'))
+        for module, expected in zip(modules, self.expected):
+            self.assertEqual(expected, writer.get_text(self.compiler.get_bundle_chunks(module)))
+
+    def test_source_map(self):
+        modules = self.compiler.finder.modules
+        with self.settings(COMPRESS_JS_FILTERS=[]):
+            writer = BundleWriter(source_maps=True)
+            path = writer.write((self.compiler.get_bundle_chunks(m) for m in modules), 'mapped.js')
+        with writer.storage.open(path) as f:
+            self.assertEqual('\n'.join(self.expected) + '\n//# sourceMappingURL={}.map'.format(os.path.basename(path)),
+                             f.read().decode('utf-8'))
+        with writer.storage.open(path + '.map') as f:
+            source_map = json.loads(f.read().decode('utf-8'))
+        self.assertEqual(os.path.basename(path), source_map['file'])
+        self.assertListEqual([
+            ({'line': 0, 'column': 0}, ['/app.js'], 'AAAA;AACA,cAAO'),
+            ({'line': 2, 'column': 0}, ['/named.js'], 'AAAA'),
+        ], [(s['offset'], s['map']['sources'], s['map']['mappings']) for s in source_map['sections']])
+
+
+class GraphCacheTests(ProjectTestCase):
+
+    def setUp(self):
+        super(GraphCacheTests, self).setUp()
+        self.write(self.template_dir, 'page.html', "<script>require(['app'], function() {});</script>")
+        self.write(self.static_dir, 'app.js', "define(['lib'], function(lib) {});")
+        self.write(self.static_dir, 'lib.js', "define(function() {});")
+        self.cache_file = os.path.join(self.root, 'graph.json')
+
+    def test_unchanged_files_are_not_read(self):
+        expected = self.get_finder(cache=FileGraphCache(self.cache_file)).modules
+
+        finder = self.get_finder(cache=FileGraphCache(self.cache_file))
+        finder.get_module_content = None  # Reading a module would now fail
+        self.assertListEqual(expected, finder.modules)
+
+    def test_changed_files_are_read(self):
+        self.get_finder(cache=FileGraphCache(self.cache_file)).modules
+        self.write(self.static_dir, 'lib.js', "define(['extra'], function(extra) {});")
+        self.write(self.static_dir, 'extra.js', "define(function() {});")
+
+        finder = self.get_finder(cache=FileGraphCache(self.cache_file))
+        self.assertIn('extra', [m.id for m in finder.modules])
+
+    def test_shared_between_threads(self):
+        class SlowGraphCache(FileGraphCache):
+            loads = 0
+
+            def load(self):
+                SlowGraphCache.loads += 1
+                time.sleep(0.01)  # Let the other threads ask for the entries meanwhile
+                return super(SlowGraphCache, self).load()
+
+        graph_cache = SlowGraphCache(self.cache_file)
+        paths = [self.write(self.static_dir, 'module{}.js'.format(i), "define(function() {});") for i in range(8)]
+        pool = ThreadPool(8)
+        try:
+            pool.map(lambda path: graph_cache.set('modules', path, [[], [None], []]), paths)
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(1, SlowGraphCache.loads)
+        self.assertEqual(8, len([p for p in paths if graph_cache.get('modules', p) is not None]))
+
+    def test_digests_of_unchanged_files_are_cached(self):
+        path = os.path.join(self.static_dir, 'lib.js')
+        finder = self.get_finder(cache=FileGraphCache(self.cache_file))
+        digest = finder.get_module_digest(path)
+        finder.save_cache()
+
+        # Same size and modification time, so the file is not hashed again
+        stat = os.stat(path)
+        self.write(self.static_dir, 'lib.js', "define(function(){ });")
+        os.utime(path, (stat.st_atime, stat.st_mtime))
+        self.assertEqual(digest, self.get_finder(cache=FileGraphCache(self.cache_file)).get_module_digest(path))
+
+        self.write(self.static_dir, 'lib.js', "define(function() { return 1; });")
+        self.assertNotEqual(digest, self.get_finder(cache=FileGraphCache(self.cache_file)).get_module_digest(path))
+
+
+class BundleWriterTests(SimpleTestCase):
+    chunks = ['define("a", function() {});', 'define("b", function() {});']
+
+    def read(self, path):
+        storage = BundleWriter().storage
+        with storage.open(path) as f:
+            return f.read().decode('utf-8')
+
+    def test_streaming(self):
+        with self.settings(COMPRESS_JS_FILTERS=[]):
+            path = BundleWriter().write(iter(self.chunks), 'streamed.js')
+        self.assertEqual('\n'.join(self.chunks), self.read(path))
+        self.assertEqual(BundleWriter().compressor.get_filepath('\n'.join(self.chunks), 'streamed.js'), path)
+
+    def test_filtered(self):
+        path = BundleWriter().write(iter(self.chunks), 'filtered.js')
+        self.assertNotIn('\n', self.read(path))
+
+    def test_precompressed(self):
+        for filters in [[], ['compressor.filters.jsmin.JSMinFilter']]:
+            with self.settings(COMPRESS_JS_FILTERS=filters):
+                writer = BundleWriter(precompress=['gzip'])
+                path = writer.write(iter(self.chunks), 'precompressed.js')
+            self.assertTrue(writer.is_written(path))
+            with writer.storage.open(path + '.gz') as f:
+                self.assertEqual(self.read(path), gzip.GzipFile(fileobj=f).read().decode('utf-8'))
+
+    @unittest.skipUnless(brotli, "brotli is not installed")
+    def test_precompressed_brotli(self):
+        with self.settings(COMPRESS_JS_FILTERS=[]):
+            writer = BundleWriter(precompress=['gzip', 'br'])
+            path = writer.write(iter(self.chunks), 'precompressed.js')
+        with writer.storage.open(path + '.br') as f:
+            self.assertEqual(self.read(path), brotli.decompress(f.read()).decode('utf-8'))
+
+    def test_unknown_precompress_format(self):
+        self.assertRaises(ImproperlyConfigured, BundleWriter, precompress=['gz'])
+
+    def test_missing_precompressed_copy(self):
+        with self.settings(COMPRESS_JS_FILTERS=[]):
+            path = BundleWriter().write(iter(self.chunks), 'uncompressed.js')
+            writer = BundleWriter(precompress=['gzip'])
+            self.assertTrue(writer.exists(path))
+            self.assertFalse(writer.is_written(path))
+
+
+class ModuleFilterCacheTests(ProjectTestCase):
+
+    def setUp(self):
+        super(ModuleFilterCacheTests, self).setUp()
+        self.filter_cache = FileFilterCache(os.path.join(self.root, 'filtered'))
+        self.filtered = []
+
+    def write_bundle(self, chunks):
+        test = self
+
+        class CountingBundleWriter(BundleWriter):
+            def filter(self, content):
+                test.filtered.append(content)
+                return super(CountingBundleWriter, self).filter(content)
+
+        writer = CountingBundleWriter(filter_cache=self.filter_cache)
+        with writer.storage.open(writer.write(iter(chunks), 'modules.js')) as f:
+            return f.read().decode('utf-8')
+
+    def test_filtered_once(self):
+        a = 'define("a", function() {  return 1;  });'
+        b = 'define("b", function() {  return 2;  });'
+        changed_b = 'define("b", function() {  return 3;  });'
+        self.assertNotIn('  ', self.write_bundle([a, b]))
+        self.assertIn('return 3', self.write_bundle([a, changed_b]))
+        self.assertListEqual([a, b, changed_b], self.filtered)
+
+
+class StaticResolutionTests(ProjectTestCase):
+
+    def setUp(self):
+        super(StaticResolutionTests, self).setUp()
+        self.write(self.static_dir, 'app.js', "define(function() {});")
+        self.write(self.static_dir, 'app.css', "")
+
+    def test_resolved_once(self):
+        finder = self.get_finder()
+        for _ in range(2):
+            self.assertEqual(os.path.join(self.static_dir, 'app.js'), finder.get_module_path('app'))
+            self.assertIsNone(finder.get_module_path('missing'))
+        self.assertListEqual(['app.js', 'missing.js'], finder.static_finder.found)
+
+    def test_static_index(self):
+        with self.settings(STATICFILES_DIRS=[self.static_dir]):
+            finder = self.get_finder(static_index=True)
+            self.assertEqual(os.path.join(self.static_dir, 'app.js'), finder.get_module_path('app'))
+            self.assertIsNone(finder.get_module_path('missing'))
+            self.assertIsNone(finder.get_module_path('app.css'))
+        self.assertListEqual([], finder.static_finder.found)
+
+
+class IncrementalBundleTests(ProjectTestCase):
+
+    def setUp(self):
+        super(IncrementalBundleTests, self).setUp()
+        self.write(self.static_dir, 'app.js', "define(['lib'], function(lib) {});")
+        self.write(self.static_dir, 'lib.js', "define(function() {});")
+        self.compiler = RequireJSCompiler('')
+        self.compiler.finder = self.get_finder(starting_dependencies=['app'])
+        self.written = []
+        clear_output()
+
+        test = self
+
+        class RecordingBundleWriter(BundleWriter):
+            def write(self, chunks, basename, digest=None):
+                test.written.append(basename)
+                return super(RecordingBundleWriter, self).write(chunks, basename, digest)
+        self.compiler.get_bundle_writer = RecordingBundleWriter
+
+    def test_unchanged_bundle_is_reused(self):
+        url = self.compiler.write_bundle('incremental', self.compiler.finder.modules)
+        self.assertEqual(url, self.compiler.write_bundle('incremental', self.compiler.finder.modules))
+        self.assertListEqual(['incremental.js'], self.written)
+
+    def test_changed_bundle_is_written(self):
+        self.compiler.write_bundle('incremental', self.compiler.finder.modules)
+        self.write(self.static_dir, 'lib.js', "define(function() { return 42; });")
+        self.compiler.write_bundle('incremental', self.compiler.finder.modules)
+        self.assertListEqual(['incremental.js', 'incremental.js'], self.written)
+
+    def test_bundle_is_written_for_other_filter_settings(self):
+        modules = self.compiler.finder.modules
+        fingerprint = self.compiler.get_bundle_fingerprint('incremental', modules)
+        with self.settings(COMPRESS_CLOSURE_COMPILER_ARGUMENTS='--language_in=ECMASCRIPT5'):
+            self.assertNotEqual(fingerprint, self.compiler.get_bundle_fingerprint('incremental', modules))
+
+        saved_version = filter_module.BUNDLE_VERSION
+        filter_module.BUNDLE_VERSION = '2'
+        try:
+            self.assertNotEqual(fingerprint, self.compiler.get_bundle_fingerprint('incremental', modules))
+        finally:
+            filter_module.BUNDLE_VERSION = saved_version
+        self.assertEqual(fingerprint, self.compiler.get_bundle_fingerprint('incremental', modules))
+
+    def test_bundle_is_written_with_source_map(self):
+        compiler = RequireJSCompiler('')
+        compiler.finder = self.compiler.finder
+        saved_source_maps = filter_module.SOURCE_MAPS
+        try:
+            with self.settings(COMPRESS_JS_FILTERS=[]):
+                url = compiler.write_bundle('incremental', compiler.finder.modules)
+                filter_module.SOURCE_MAPS = True
+                mapped_url = compiler.write_bundle('incremental', compiler.finder.modules)
+        finally:
+            filter_module.SOURCE_MAPS = saved_source_maps
+        self.assertNotEqual(url, mapped_url)
+        storage = BundleWriter().storage
+        self.assertTrue(storage.exists(os.path.join(compressor_settings.COMPRESS_OUTPUT_DIR, 'js',
+                                                    os.path.basename(mapped_url) + '.map')))
+
+    def test_existing_bundle_in_storage_is_reused(self):
+        url = self.compiler.write_bundle('incremental', self.compiler.finder.modules)
+
+        # Another process, sharing the storage but nothing else
+        compiler = RequireJSCompiler('')
+        compiler.finder = self.get_finder(starting_dependencies=['app'])
+        compiler.get_bundle_writer = self.compiler.get_bundle_writer
+        compiler.get_bundle_chunks = None  # Bundling modules would now fail
+        self.assertEqual(url, compiler.write_bundle('incremental', compiler.finder.modules))
+        self.assertListEqual(['incremental.js'], self.written)
+
+
+class MemoryModuleFinder(ModuleFinder):
+    """
+    Module finder serving module sources from a dict instead of files.
+    """
+
+    def __init__(self, sources, **kwargs):
+        super(MemoryModuleFinder, self).__init__(tuple(), None, **kwargs)
+        self.sources = sources
+
+    def get_module_path(self, module_id):
+        return module_id if module_id in self.sources else None
+
+    def get_module_content(self, path):
+        return self.sources[path]
+
+
+class GraphTraversalTests(SimpleTestCase):
+
+    def test_deep_graph(self):
+        # Deeper than the recursion limit
+        depth = sys.getrecursionlimit() * 2
+        sources = {
+            'module{}'.format(i): "define(['module{}'], function() {{}});".format(i + 1) for i in range(depth)
+        }
+        modules = MemoryModuleFinder(sources).get_modules_from(['module0'])
+        self.assertEqual(depth, len(modules))
+
+    def test_no_doubles(self):
+        finder = MemoryModuleFinder({
+            'app': "define(['lib', 'named'], function() {}); define(['lib'], function() {});",
+            'lib': "define(function() {});",
+            'named': "define('named', ['lib'], function() {});",
+        })
+        modules = finder.get_modules_from(['app', 'lib'])
+        self.assertListEqual(['app', 'lib', 'named'], [m.id for m in modules])
+
+
+class ModuleIndexTests(ProjectTestCase):
+
+    def setUp(self):
+        super(ModuleIndexTests, self).setUp()
+        self.write(self.template_dir, 'page.html', "<script>require(['app']);</script>")
+        self.write(self.static_dir, 'app.js', "define(['lib', 'text!tpl'], function() {});")
+        self.write(self.static_dir, 'lib.js', "define('lib', function() {}); define('lib/extra', function() {});")
+        self.write(self.static_dir, 'text.js', "define(function() {});")
+        self.finder = self.get_finder()
+
+    def test_found_once(self):
+        self.finder.modules
+        self.finder.get_module_content = None  # Reading a module would now fail
+        self.assertEqual(4, len(self.finder.modules))
+
+    def test_indexes(self):
+        self.assertEqual('app', self.finder.get_module('app').location)
+        self.assertIsNone(self.finder.get_module('tpl'))
+        self.assertListEqual(['lib', 'lib/extra'], [m.id for m in self.finder.get_modules_at('lib')])
+        self.assertListEqual(['app'], [m.id for m in self.finder.get_dependents('lib')])
+        self.assertListEqual(['app'], [m.id for m in self.finder.get_dependents('text')])
+        self.assertListEqual(['app', 'lib', 'lib/extra', 'text'],
+                             [m.id for m in self.finder.get_template_modules('page.html')])
+
+    def test_invalidate(self):
+        self.finder.modules
+        self.write(self.static_dir, 'lib.js', "define(function() {});")
+        self.finder.invalidate()
+        self.assertListEqual(['app', 'lib', 'text'], [m.id for m in self.finder.modules])
+
+
+class TemplateDiscoveryTests(ProjectTestCase):
+
+    def setUp(self):
+        super(TemplateDiscoveryTests, self).setUp()
+        self.write(self.template_dir, 'page.html', "<script>require(['page']);</script>")
+        self.write(self.template_dir, 'app/templates/app.html', "<script>require(['app']);</script>")
+        self.write(self.template_dir, 'robots.txt', "require(['robots']);")
+        with open(os.path.join(self.template_dir, 'image.png'), 'wb') as f:
+            f.write(b'\x89PNG\xff require')
+
+    def get_template_names(self, finder):
+        return sorted(finder.get_template_name(path) for path in finder.get_template_files())
+
+    def test_overlapping_directories_walked_once(self):
+        app_dir = os.path.join(self.template_dir, 'app', 'templates')
+        finder = ModuleFinder([app_dir, self.template_dir, app_dir + os.sep], DirectoryFinder(self.static_dir))
+        self.assertListEqual(['app.html', 'image.png', 'page.html', 'robots.txt'], self.get_template_names(finder))
+        self.assertSetEqual({'app', 'page', 'robots'}, finder.get_template_dependencies())
+
+    def test_include_exclude(self):
+        finder = self.get_finder(template_include=['*.html', '*.txt'], template_exclude=['app/*'])
+        self.assertListEqual(['page.html', 'robots.txt'], self.get_template_names(finder))
+        self.assertSetEqual({'page', 'robots'}, finder.get_template_dependencies())
+
+
+class LeafModuleTests(ProjectTestCase):
+
+    def setUp(self):
+        super(LeafModuleTests, self).setUp()
+        self.write(self.static_dir, 'app.js', "define(['vendor/big', 'vendor/min', 'lib'], function() {});")
+        self.write(self.static_dir, 'vendor/big.js', "define(['unused'], function() {});\n" + "// Filler\n" * 20)
+        self.write(self.static_dir, 'vendor/min.js', "define(['minified'],function(){" + ";" * 200 + "});")
+        self.write(self.static_dir, 'lib.js', "define(['other'], function() {});")
+        for name in ['unused', 'minified', 'other']:
+            self.write(self.static_dir, name + '.js', "define(function() {});")
+
+    def get_module_ids(self, **kwargs):
+        return [m.id for m in self.get_finder(**kwargs).get_modules_from(['app'])]
+
+    def test_leaves(self):
+        everything = ['app', 'vendor/big', 'vendor/min', 'lib', 'unused', 'minified', 'other']
+        self.assertListEqual(everything, self.get_module_ids())
+        self.assertListEqual(['app', 'vendor/big', 'vendor/min', 'lib'],
+                             self.get_module_ids(leaf_patterns=['vendor/*', 'l?b']))
+        self.assertListEqual(['app', 'vendor/big', 'vendor/min', 'lib', 'other'], self.get_module_ids(leaf_size=200))
+        self.assertListEqual(['app', 'vendor/big', 'vendor/min', 'lib', 'unused', 'other'],
+                             self.get_module_ids(leaf_line_length=120))
+        self.assertListEqual(everything, self.get_module_ids(leaf_line_length=1000))
+
+    def test_umd_and_plain_leaves(self):
+        self.write(self.static_dir, 'vendor/umd.js',
+                   '!function(e){"function"==typeof define&&define.amd?define(["jquery"],e):e(jQuery)}(function(){});')
+        self.write(self.static_dir, 'vendor/named.js', 'typeof define=="function"&&define("named",[],function(){});')
+        self.write(self.static_dir, 'vendor/plain.js', 'window.plain=function(){};')
+        compiler = RequireJSCompiler('')
+        compiler.finder = self.get_finder(leaf_patterns=['vendor/*'],
+                                          cache=FileGraphCache(os.path.join(self.root, 'graph.json')))
+        umd, named = compiler.finder.get_modules_from(['vendor/umd', 'vendor/named', 'vendor/plain'])
+        self.assertEqual('!function(e){"function"==typeof define&&define.amd?define("vendor/umd", ["jquery"],e)'
+                         ':e(jQuery)}(function(){});', compiler.get_bundle_module(umd))
+        self.assertEqual(('named', True), (named.id, named.named))
+
+        compiler.finder.save_cache()
+        finder = self.get_finder(leaf_patterns=['vendor/*'],
+                                 cache=FileGraphCache(os.path.join(self.root, 'graph.json')))
+        self.assertListEqual([umd, named], finder.get_modules_from(['vendor/umd', 'vendor/named', 'vendor/plain']))
+        self.assertEqual(0, finder.stats['modules_read'])
+
+    def test_leaf_is_bundled(self):
+        compiler = RequireJSCompiler('')
+        compiler.finder = self.get_finder(leaf_patterns=['vendor/*'])
+        module, = compiler.finder.get_modules_from(['vendor/min'])
+        self.assertEqual('define("vendor/min", [\'minified\'],function(){' + ';' * 200 + '});',
+                         compiler.get_bundle_module(module))
+
+
+class ParallelScanTests(ProjectTestCase):
+
+    def test_same_as_serial(self):
+        for i in range(20):
+            self.write(self.template_dir, 'page{}.html'.format(i), "<script>require(['page{}']);</script>".format(i))
+            self.write(self.static_dir, 'page{}.js'.format(i), "define(['lib{}', 'lib'], function() {{}});".format(i))
+            self.write(self.static_dir, 'lib{}.js'.format(i), "define(['lib'], function() {});")
+        self.write(self.static_dir, 'lib.js', "define(function() {});")
+
+        self.assertListEqual(self.get_finder().modules, self.get_finder(workers=4).modules)
+
+
+class ParallelBundleTests(ProjectTestCase):
+
+    def setUp(self):
+        super(ParallelBundleTests, self).setUp()
+        self.write(self.static_dir, 'app.js', "define(['lib', 'extra'], function() {});")
+        self.write(self.static_dir, 'lib.js', "define(function() {});")
+        self.write(self.static_dir, 'extra.js', "define(function() {});")
+        self.compiler = RequireJSCompiler('')
+        self.compiler.finder = self.get_finder(starting_dependencies=['app'])
+        self.saved_settings = (filter_module.CONFIG, filter_module.BUNDLE_WORKERS)
+        filter_module.CONFIG = {'bundles': {'lib': ['lib'], 'extra': ['extra']}}
+
+    def tearDown(self):
+        filter_module.CONFIG, filter_module.BUNDLE_WORKERS = self.saved_settings
+        super(ParallelBundleTests, self).tearDown()
+
+    def test_same_as_serial(self):
+        filter_module.BUNDLE_WORKERS = None
+        serial = self.compiler.get_bundles()
+        filter_module.BUNDLE_WORKERS = 3
+        parallel = self.compiler.get_bundles()
+        self.assertEqual(serial, parallel)
+        self.assertListEqual([['extra'], ['lib'], ['app']], list(parallel[0].values()))
+
+
+class CountingStorage(FileSystemStorage):
+    """
+    Local stand-in for a remote storage, counting the calls which would be round trips.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CountingStorage, self).__init__(*args, **kwargs)
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def record(self, method):
+        with self.lock:
+            self.calls.append(method)
+
+    def exists(self, name):
+        self.record('exists')
+        return super(CountingStorage, self).exists(name)
+
+    def listdir(self, path):
+        self.record('listdir')
+        return super(CountingStorage, self).listdir(path)
+
+    def get_available_name(self, name, *args, **kwargs):
+        return name  # Overwrite, like remote storages usually do, instead of checking for an existing file
+
+    def _save(self, name, content):
+        self.record('save')
+        return super(CountingStorage, self)._save(name, content)
+
+
+class UploadTests(ProjectTestCase):
+
+    def setUp(self):
+        super(UploadTests, self).setUp()
+        self.write(self.static_dir, 'app.js', "define(['lib', 'extra'], function() {});")
+        self.write(self.static_dir, 'lib.js', "define(function() {});")
+        self.write(self.static_dir, 'extra.js', "define(function() {});")
+        self.storage = CountingStorage(location=os.path.join(self.root, 'output'), base_url='/static/')
+        self.saved_settings = (filter_module.CONFIG, filter_module.UPLOAD_WORKERS)
+        filter_module.CONFIG = {'bundles': {'lib': ['lib'], 'extra': ['extra']}}
+        filter_module.UPLOAD_WORKERS = 3
+        clear_output()
+
+    def tearDown(self):
+        filter_module.CONFIG, filter_module.UPLOAD_WORKERS = self.saved_settings
+        super(UploadTests, self).tearDown()
+
+    def get_bundles(self):
+        storage = self.storage
+
+        class FakeStorageBundleWriter(BundleWriter):
+            @property
+            def storage(self):
+                return storage
+
+        compiler = RequireJSCompiler('')
+        compiler.finder = self.get_finder(starting_dependencies=['app'])
+        compiler.get_bundle_writer = lambda: FakeStorageBundleWriter(
+            existing=compiler.existing_bundles, uploads=compiler.uploads)
+        return compiler.get_bundles()[0]
+
+    def test_one_listing(self):
+        bundles = self.get_bundles()
+        self.assertListEqual(['listdir', 'save', 'save', 'save'], self.storage.calls)
+        for url in bundles:
+            self.assertTrue(self.storage.exists(url[len('/static/'):]))
+
+        # Everything exists now
+        self.storage.calls = []
+        self.assertEqual(bundles, self.get_bundles())
+        self.assertListEqual(['listdir'], self.storage.calls)
+
+
+class SplitBundleTests(ProjectTestCase):
+
+    def setUp(self):
+        super(SplitBundleTests, self).setUp()
+        self.write(self.template_dir, 'pages/home.html', "<script>require(['home']);</script>")
+        self.write(self.template_dir, 'pages/about.html', "<script>require(['about']);</script>")
+        self.write(self.static_dir, 'home.js', "define(['lib', 'home_lib'], function() {});")
+        self.write(self.static_dir, 'home_lib.js', "define(function() {});")
+        self.write(self.static_dir, 'about.js', "define(['lib'], function() {});")
+        self.write(self.static_dir, 'lib.js', "define(function() {});")
+        self.write(self.static_dir, 'extra.js', "define(function() {});")
+
+    def test_split(self):
+        finder = self.get_finder(starting_dependencies=['extra'])
+        bundles, remaining = split_by_entries(
+            finder.get_template_entries(), finder.modules, finder.get_modules_from)
+        self.assertListEqual([
+            ('pages-about', ['about']),
+            ('pages-home', ['home', 'home_lib']),
+            ('shared', ['lib']),
+        ], [(name, [m.id for m in modules]) for name, modules in bundles])
+        self.assertListEqual(['extra'], [m.id for m in remaining])
+
+    def test_shared_minimum(self):
+        finder = self.get_finder()
+        bundles, remaining = split_by_entries(
+            finder.get_template_entries(), finder.modules, finder.get_modules_from, shared_minimum=3)
+        self.assertEqual(3, len(bundles))
+        self.assertTrue(bundles[-1][0].startswith('shared-'))
+
+
+class PackingTests(SimpleTestCase):
+
+    @staticmethod
+    def get_modules(count, dependencies=None):
+        dependencies = dependencies or {}
+        return [Module(id='module{:03}'.format(i), location='module{:03}'.format(i),
+                       dependencies=dependencies.get(i, []), named=False) for i in range(count)]
+
+    def test_clusters(self):
+        modules = self.get_modules(4, {0: ['module001'], 1: ['module002'], 2: ['module000', 'text!module003']})
+        modules.append(Module(id='extra', location='module003', dependencies=[], named=True))
+        self.assertListEqual([['module000', 'module001', 'module002'], ['module003', 'extra']],
+                             [[m.id for m in cluster] for cluster in get_clusters(modules)])
+
+    def test_sizes(self):
+        modules = self.get_modules(40, {0: ['module001'], 1: ['module000']})
+        bundles = pack_by_size(modules, lambda m: 10, 100)
+        self.assertListEqual([m.id for m in modules], sorted(m.id for _, bundle in bundles for m in bundle))
+        for name, bundle in bundles:
+            self.assertTrue(name.startswith('main-'))
+            self.assertLessEqual(len(bundle), 10)
+        self.assertEqual(1, len([b for _, b in bundles if modules[0] in b and modules[1] in b]))
+
+    def test_stable(self):
+        modules = self.get_modules(200)
+        sizes = dict((m.id, 10) for m in modules)
+
+        def pack():
+            return set((name, tuple(m.id for m in bundle)) for name, bundle in pack_by_size(
+                modules, lambda m: sizes[m.id], 100))
+
+        before = pack()
+        sizes['module050'] = 60
+        after = pack()
+        self.assertGreater(len(after), 20)
+        self.assertLessEqual(len(after - before), 2)
+
+
+class MainBundleTests(ProjectTestCase):
+
+    def setUp(self):
+        super(MainBundleTests, self).setUp()
+        self.write(self.static_dir, 'app.js', "define(['lib'], function() {});")
+        self.write(self.static_dir, 'lib.js', "define(function() {});")
+        self.compiler = RequireJSCompiler('')
+        self.compiler.finder = self.get_finder(starting_dependencies=['app'])
+        self.saved_size = filter_module.MAIN_BUNDLE_SIZE
+        filter_module.MAIN_BUNDLE_SIZE = 1
+        clear_output()
+
+    def tearDown(self):
+        filter_module.MAIN_BUNDLE_SIZE = self.saved_size
+        super(MainBundleTests, self).tearDown()
+
+    def test_packed(self):
+        bundles, main_modules = self.compiler.get_bundles()
+        self.assertEqual(2, len(bundles))
+        self.assertListEqual([], main_modules)
+
+    def test_included_main_bundle_is_not_packed(self):
+        bundles, main_modules = self.compiler.get_bundles(skip_main_bundle=True)
+        self.assertListEqual([['lib', 'app']], list(bundles.values()))
+        self.assertListEqual(['lib', 'app'], [m.id for m in main_modules])
+
+
+class DependencyOrderTests(SimpleTestCase):
+
+    @staticmethod
+    def get_ids(modules):
+        return [m.id for m in sort_by_dependencies(modules)]
+
+    def test_order(self):
+        modules = [
+            Module(id='app', location='app', dependencies=['lib', 'text!tpl', 'missing'], named=False),
+            Module(id='tpl', location='tpl', dependencies=[], named=False),
+            Module(id='lib', location='lib', dependencies=['base'], named=False),
+            Module(id='base', location='base', dependencies=[], named=False),
+            Module(id='text', location='text', dependencies=[], named=False),
+        ]
+        self.assertListEqual(['base', 'lib', 'text', 'app', 'tpl'], self.get_ids(modules))
+        self.assertListEqual(['base', 'lib', 'text', 'app', 'tpl'], self.get_ids(reversed(modules)))
+
+    def test_cycle(self):
+        modules = [
+            Module(id='c', location='c', dependencies=['a'], named=False),
+            Module(id='b', location='b', dependencies=['a'], named=False),
+            Module(id='a', location='a', dependencies=['b'], named=False),
+        ]
+        self.assertListEqual(['a', 'b', 'c'], self.get_ids(modules))
+
+
+class InstrumentationTests(ProjectTestCase):
+
+    def setUp(self):
+        super(InstrumentationTests, self).setUp()
+        self.write(self.template_dir, 'page.html', "<script>require(['app']);</script>")
+        self.write(self.static_dir, 'app.js', "define(function() {});")
+        self.events = []
+        phase_finished.connect(self.receive)
+        bundle_written.connect(self.receive)
+        clear_output()
+
+    def tearDown(self):
+        phase_finished.disconnect(self.receive)
+        bundle_written.disconnect(self.receive)
+        super(InstrumentationTests, self).tearDown()
+
+    def receive(self, signal, **kwargs):
+        self.events.append(kwargs)
+
+    def test_signals(self):
+        compiler = RequireJSCompiler('')
+        compiler.finder = self.get_finder()
+        compiler.get_bundles()
+
+        templates, modules, bundle, bundles = self.events
+        self.assertEqual('templates', templates['phase'])
+        self.assertEqual({'templates': 1, 'templates_read': 1, 'templates_cached': 0}, templates['stats'])
+        self.assertEqual({'modules': 1, 'modules_read': 1, 'modules_cached': 0}, modules['stats'])
+
+        # Counts are for every run on its own
+        del self.events[:]
+        compiler.finder.invalidate()
+        compiler.finder.modules
+        self.assertEqual({'templates': 1, 'templates_read': 1, 'templates_cached': 0}, self.events[0]['stats'])
+        self.assertEqual({'modules': 1, 'modules_read': 1, 'modules_cached': 0}, self.events[1]['stats'])
+        self.assertEqual('main', bundle['name'])
+        self.assertFalse(bundle['reused'])
+        self.assertEqual(len('define("app", function() {});'), bundle['input_size'])
+        self.assertEqual({'bundles': 1, 'bundles_written': 1, 'bundles_reused': 0}, bundles['stats'])
+
+
+class OutputCacheTests(SimpleTestCase):
+
+    def test_lru(self):
+        lru = LRUCache(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual(1, lru.get('a'))
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(3, lru.get('c'))
+
+    def test_output_cached_when_not_compressing(self):
+        filter_module.output_cache.clear()
+        with self.settings(COMPRESS_ENABLED=False):
+            output = RequireJSCompiler('/* require.js */', attrs={'data-main': 'app'}).input()
+
+            compiler = RequireJSCompiler('/* require.js */', attrs={'data-main': 'app'})
+            compiler.get_require_config = None  # Generating the config would now fail
+            self.assertEqual(output, compiler.input())
+
+            # Other RequireJS source, other output
+            self.assertNotEqual(output, RequireJSCompiler('/* other */', attrs={'data-main': 'app'}).input())
+
+
+class ManifestTests(ProjectTestCase):
+
+    def setUp(self):
+        super(ManifestTests, self).setUp()
+        self.write(self.static_dir, 'app.js', "define(function() {});")
+        self.saved_manifest = filter_module.MANIFEST
+        filter_module.MANIFEST = requirejs_manifest.MANIFEST = 'requirejs-test.json'
+
+    def tearDown(self):
+        filter_module.MANIFEST = requirejs_manifest.MANIFEST = self.saved_manifest
+        manifest.default_storage.delete(manifest.get_manifest_filename('requirejs-test.json'))
+        manifest._manifest = None
+        super(ManifestTests, self).tearDown()
+
+    def test_no_finder_with_manifest(self):
+        compiler = RequireJSCompiler('', attrs={'data-main': 'app'})
+        compiler.finder = self.get_finder(starting_dependencies=['app'])
+        config, main_bundle = compiler.get_require_config(forced=True)
+        manifest.write_manifest('requirejs-test.json', {'app': {'config': config, 'main_bundle': main_bundle}})
+        manifest._manifest = None  # Load it like a fresh process would
+
+        compiler = RequireJSCompiler('', attrs={'data-main': 'app'})
+        compiler.get_module_finder = None  # Finding modules would now fail
+        with self.settings(COMPRESS_ENABLED=True):
+            self.assertEqual(
+                'var require = {};'.format(json.dumps(config)),
+                compiler.input()
+            )
+
+    def test_missing_manifest_is_looked_for_again(self):
+        self.assertEqual({}, manifest.get_manifest('requirejs-test.json'))
+        # Written by another process
+        manifest.default_storage.save(manifest.get_manifest_filename('requirejs-test.json'),
+                                      ContentFile(b'{"app": {}}'))
+        self.assertListEqual(['app'], list(manifest.get_manifest('requirejs-test.json')))
+
+    def test_replaced(self):
+        manifest.write_manifest('requirejs-test.json', {'app': {}})
+        manifest.write_manifest('requirejs-test.json', {'other': {}})
+        manifest._manifest = None
+        self.assertListEqual(['other'], list(manifest.get_manifest('requirejs-test.json')))
+
+    def test_command(self):
+        test = self
+
+        class ProjectCompiler(RequireJSCompiler):
+            def create_module_finder(self, main=None, watcher=None):
+                return test.get_finder(starting_dependencies=[main] if main else [])
+
+        saved_compiler = requirejs_manifest.RequireJSCompiler
+        requirejs_manifest.RequireJSCompiler = ProjectCompiler
+        try:
+            call_command('requirejs_manifest', 'app', stdout=StringIO())
+        finally:
+            requirejs_manifest.RequireJSCompiler = saved_compiler
+
+        manifest._manifest = None
+        entries = manifest.get_manifest('requirejs-test.json')
+        self.assertListEqual(['', 'app'], sorted(entries))
+        self.assertListEqual([['app']], list(entries['app']['config']['bundles'].values()))
+
+
+class WatcherTests(ProjectTestCase):
+
+    def setUp(self):
+        super(WatcherTests, self).setUp()
+        self.write(self.template_dir, 'page.html', "<script>require(['app']);</script>")
+        self.write(self.static_dir, 'app.js', "define(['lib'], function() {});")
+        self.lib = self.write(self.static_dir, 'lib.js', "define(function() {});")
+
+    def assertChangesSeen(self, watcher):
+        watcher.watch_directories([self.template_dir])
+        watcher.watch_files([self.lib])
+        self.assertSetEqual(set(), watcher.get_changes())
+
+        page = self.write(self.template_dir, 'pages/other.html', "<p>Other</p>")
+        self.write(self.static_dir, 'lib.js', "define(['extra'], function() {});")
+        self.write(self.static_dir, 'unwatched.js', "define(function() {});")
+        self.assertSetEqual({page, self.lib}, watcher.get_changes())
+        self.assertSetEqual(set(), watcher.get_changes())
+
+    def test_polling_watcher(self):
+        self.assertChangesSeen(PollingWatcher())
+
+    @unittest.skipUnless(inotify_simple, "inotify_simple is not installed")
+    def test_inotify_watcher(self):
+        self.assertChangesSeen(InotifyWatcher())
+
+    def test_only_changed_files_read(self):
+        finder = self.get_finder(watcher=PollingWatcher())
+        self.assertListEqual(['app', 'lib'], [m.id for m in finder.modules])
+        version = finder.version
+
+        self.write(self.static_dir, 'extra.js', "define(function() {});")
+        self.write(self.static_dir, 'lib.js', "define(['extra'], function() {});")
+        self.assertListEqual(['app', 'lib', 'extra'], [m.id for m in finder.modules])
+        self.assertEqual(2, finder.stats['modules_read'])  # app.js was not read again
+        self.assertEqual(0, finder.stats['templates_read'])
+        self.assertGreater(finder.version, version)
+
+        version = finder.version
+        finder.modules
+        self.assertEqual(version, finder.version)
+
+    def test_missing_module_found_once_added(self):
+        finder = self.get_finder(watcher=PollingWatcher())
+        self.write(self.static_dir, 'lib.js', "define(['extra'], function() {});")
+        self.assertListEqual(['app', 'lib'], [m.id for m in finder.modules])
+        self.assertIsNone(finder.get_module('extra'))
+
+        self.write(self.static_dir, 'extra.js', "define(function() {});")
+        self.assertIsNotNone(finder.get_module('extra'))
+        self.assertListEqual(['app', 'lib', 'extra'], [m.id for m in finder.modules])
+
+    def test_refreshed_once_per_render(self):
+        class CountingWatcher(PollingWatcher):
+            calls = 0
+
+            def get_changes(self):
+                CountingWatcher.calls += 1
+                return super(CountingWatcher, self).get_changes()
+
+        compiler = RequireJSCompiler('')
+        compiler.finder = self.get_finder(watcher=CountingWatcher())
+        saved_watch = filter_module.WATCH
+        filter_module.WATCH = True
+        try:
+            with self.settings(COMPRESS_ENABLED=True):
+                compiler.input()
+        finally:
+            filter_module.WATCH = saved_watch
+        self.assertEqual(1, CountingWatcher.calls)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -33,3 +33,18 @@ def get_installed_app_labels():
         return [app.label for app in apps.get_app_configs()]
     else:
         return [app.split('.')[-1] for app in settings.INSTALLED_APPS]
+
+
+def get_cache(alias):
+    """
+    Get one of the configured Django caches by its alias.
+    """
+    if django.VERSION >= (1, 7):
+        from django.core.cache import caches
+
+        return caches[alias]
+    else:
+        # noinspection PyUnresolvedReferences
+        from django.core.cache import get_cache as django_get_cache
+
+        return django_get_cache(alias)
@@ -0,0 +1,134 @@
+import os
+
+try:
+    # noinspection PyPackageRequirements
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+
+class PollingWatcher(object):
+    """
+    Detect changed files by comparing their modification time and size every time changes are asked for.
+
+    Directories are watched recursively, so files added to them are detected as well.
+    """
+
+    def __init__(self):
+        self.directories = set()
+        self.files = set()
+        self.signatures = {}
+
+    def watch_directories(self, directories):
+        new_directories = set(directories) - self.directories
+        self.directories.update(new_directories)
+        for directory in new_directories:
+            self.signatures.update(self.get_directory_signatures(directory))
+
+    def watch_files(self, paths):
+        new_files = set(paths) - self.files
+        self.files.update(new_files)
+        for path in new_files:
+            self.signatures[path] = self.get_signature(path)
+
+    def get_changes(self):
+        """
+        Return the paths of all files which were changed, added or removed since the last call.
+        """
+        signatures = {}
+        for directory in self.directories:
+            signatures.update(self.get_directory_signatures(directory))
+        for path in self.files:
+            signatures[path] = self.get_signature(path)
+
+        changes = set(
+            path for path in set(signatures) | set(self.signatures)
+            if signatures.get(path) != self.signatures.get(path)
+        )
+        self.signatures = signatures
+        return changes
+
+    def get_directory_signatures(self, directory):
+        signatures = {}
+        for path, dir_names, file_names in os.walk(directory):
+            for filename in file_names:
+                file_path = os.path.join(path, filename)
+                signatures[file_path] = self.get_signature(file_path)
+        return signatures
+
+    @staticmethod
+    def get_signature(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size
+
+
+class InotifyWatcher(object):
+    """
+    Detect changed files with inotify, which only needs to look at the events the kernel queued for us.
+
+    Files are watched through their directory, so files replaced by editors which save to a new file are detected.
+    """
+    mask = 0
+
+    def __init__(self):
+        flags = inotify_simple.flags
+        self.mask = (flags.CLOSE_WRITE | flags.MODIFY | flags.CREATE | flags.DELETE | flags.MOVED_FROM |
+                     flags.MOVED_TO)
+        self.inotify = inotify_simple.INotify()
+        self.watches = {}
+        self.recursive = set()
+        self.files = set()
+
+    def watch_directories(self, directories):
+        for directory in directories:
+            for path, dir_names, file_names in os.walk(directory):
+                self.add_watch(path, recursive=True)
+
+    def watch_files(self, paths):
+        for path in set(paths) - self.files:
+            self.files.add(path)
+            self.add_watch(os.path.dirname(path))
+
+    def add_watch(self, directory, recursive=False):
+        if directory not in self.watches.values():
+            try:
+                self.watches[self.inotify.add_watch(directory, self.mask)] = directory
+            except OSError:
+                return  # Removed in the meantime
+        if recursive:
+            self.recursive.add(directory)
+
+    def get_changes(self):
+        """
+        Return the paths of all files which were changed, added or removed since the last call.
+        """
+        changes = set()
+        for event in self.inotify.read(timeout=0):
+            directory = self.watches.get(event.wd)
+            if directory is None or not event.name:
+                continue
+            path = os.path.join(directory, event.name)
+            if event.mask & inotify_simple.flags.ISDIR:
+                if directory in self.recursive and os.path.isdir(path):
+                    # Watch new directories too, and report the files which were added with them
+                    self.watch_directories([path])
+                    for sub_path, dir_names, file_names in os.walk(path):
+                        changes.update(os.path.join(sub_path, filename) for filename in file_names)
+            elif directory in self.recursive or path in self.files:
+                changes.add(path)
+        return changes
+
+
+def get_watcher():
+    """
+    Use inotify when available (``inotify_simple`` on Linux), and fall back to polling.
+    """
+    if inotify_simple is not None:
+        try:
+            return InotifyWatcher()
+        except OSError:
+            pass
+    return PollingWatcher()
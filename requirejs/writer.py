@@ -0,0 +1,374 @@
+import os
+import json
+import errno
+import hashlib
+import tempfile
+import time
+import zlib
+from itertools import chain
+from multiprocessing.pool import ThreadPool
+
+try:
+    # noinspection PyPackageRequirements
+    import brotli
+except ImportError:
+    brotli = None
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile, File
+from django.utils.six import text_type, binary_type
+
+from .sourcemap import IndexSourceMap
+
+# Extensions of the precompressed copies of bundles, per format
+PRECOMPRESSED_EXTENSIONS = {'gzip': '.gz', 'br': '.br'}
+
+
+def get_content_digest():
+    """
+    Hash object to name files by their content with, using the algorithm compressor names its files with: md5
+    before django_compressor 2.0, sha256 since.
+    """
+    # noinspection PyPackageRequirements
+    from compressor.cache import get_hexdigest
+
+    return hashlib.new('sha256' if len(get_hexdigest('')) == 64 else 'md5')
+
+
+class UploadQueue(object):
+    """
+    Save files to a storage in the background, with a pool of threads sharing the storage and its connections.
+
+    Saving to remote storages is mostly waiting on the network, so a few files can be saved at the same time.
+    """
+
+    def __init__(self, storage, workers):
+        self.storage = storage
+        self.pool = ThreadPool(workers)
+        self.results = []
+
+    def save(self, path, content):
+        self.results.append(self.pool.apply_async(self.save_file, (path, content)))
+
+    def save_file(self, path, content):
+        try:
+            self.storage.save(path, content)
+        finally:
+            content.close()
+
+    def join(self):
+        """
+        Wait until all files are saved, raising the first error if any save failed.
+        """
+        self.pool.close()
+        self.pool.join()
+        for result in self.results:
+            result.get()
+
+
+class Precompressor(object):
+    """
+    Compress a file in the given formats while it is written, into a temporary file per format.
+    """
+
+    def __init__(self, formats):
+        self.check_formats(formats)
+        self.copies = []
+        for compression_format in formats:
+            if compression_format == 'gzip':
+                # Without a file name and modification time in the header, so the output only depends on the input
+                compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                compress, finish = compressor.compress, compressor.flush
+            else:
+                compressor = brotli.Compressor(quality=11)
+                compress, finish = (lambda data, c=compressor: c.process(bytes(data))), compressor.finish
+            extension = PRECOMPRESSED_EXTENSIONS[compression_format]
+            self.copies.append((extension, compress, finish, tempfile.TemporaryFile()))
+
+    @staticmethod
+    def check_formats(formats):
+        for compression_format in formats:
+            if compression_format not in PRECOMPRESSED_EXTENSIONS:
+                raise ImproperlyConfigured("Unknown compression format {}".format(compression_format))
+            if compression_format == 'br' and brotli is None:
+                raise ImproperlyConfigured("Precompressing bundles with brotli needs the brotli package")
+
+    def write(self, data):
+        for extension, compress, finish, f in self.copies:
+            f.write(compress(data))
+
+    def save(self, writer, path):
+        """
+        Save the compressed copies next to path, using the writer.
+        """
+        for extension, compress, finish, f in self.copies:
+            f.write(finish())
+            writer.save(path + extension, File(f))
+
+    def close(self):
+        for extension, compress, finish, f in self.copies:
+            f.close()
+
+
+class SourceChunk(object):
+    """
+    Chunk of a bundle copied from a source file, with the URL of the source for source maps.
+
+    The pieces are (piece, inserted) pairs, where inserted pieces are not part of the source. Iterating over the chunk
+    gives just the pieces, like any other chunk.
+    """
+
+    def __init__(self, source, pieces):
+        self.source = source
+        self.pieces = pieces
+
+    def __iter__(self):
+        return (piece for piece, inserted in self.pieces)
+
+
+class BundleWriter(object):
+    """
+    Leverage django-compressor's JsCompressor to write bundles, making use of configured filters, storage and
+    other settings.
+    """
+
+    def __init__(self, compressor=None, existing=None, uploads=None, filter_cache=None, source_maps=False,
+                 precompress=None):
+        # Imported here since compressor.base needs the app registry, which would keep ``requirejs`` from being
+        # listed in INSTALLED_APPS for its management command
+        from .js import JsCompressor
+
+        self.compressor = compressor or JsCompressor()
+        # Paths known to exist in storage, to save asking the storage, and the queue to save files with
+        self.existing = existing
+        self.uploads = uploads
+        # Filtered output of single modules, to filter modules one at a time instead of whole bundles
+        self.filter_cache = filter_cache
+        # Whether to write an index source map next to bundles, for the chunks which are a SourceChunk
+        self.source_maps = source_maps
+        # Formats to save compressed copies of bundles in, like ``gzip`` and ``br``
+        self.precompress = precompress
+        if precompress:
+            Precompressor.check_formats(precompress)
+        # Sizes (in characters when filtered, in bytes otherwise) and filter time of the last written bundle
+        self.stats = {}
+
+    @property
+    def storage(self):
+        return self.compressor.storage
+
+    def write(self, chunks, basename, digest=None):
+        """
+        Write the content of a bundle, given as an iterable of chunks, which will be joined by newlines. A chunk is
+        text, bytes or an iterable of pieces of text or bytes-like objects, like a memory map.
+
+        Filters need the full content, so it is only buffered and decoded when there are filters configured.
+        Otherwise, the chunks are streamed to a temporary file which is saved to storage. With a filter cache, every
+        chunk is filtered on its own, and only when it is not in the cache yet.
+
+        The file is named by the given digest, or by the hash of its output like compressor does when there is none.
+
+        With source maps, the map is saved next to the bundle with a ``.map`` extension. Filtered bundles only get a
+        map when modules are filtered one at a time, and then only the start of every module is mapped.
+
+        Compressed copies are written along with the bundle, with a ``.gz`` or ``.br`` extension, for every format to
+        precompress bundles in.
+
+        Returns the path of the written file in compressor's storage.
+        """
+        if self.compressor.cached_filters and self.filter_cache is not None:
+            return self.write_filtered_chunks(chunks, basename, digest)
+        if self.compressor.cached_filters:
+            return self.write_filtered('\n'.join(self.get_text(chunk) for chunk in chunks), basename, digest)
+        return self.write_streaming(chunks, basename, digest)
+
+    def write_filtered(self, content, basename, digest=None):
+        start = time.time()
+        output = self.filter(content)
+        self.stats = {'input_size': len(content), 'output_size': len(output), 'filter_time': time.time() - start}
+        return self.save_output(output, basename, digest)
+
+    def write_filtered_chunks(self, chunks, basename, digest=None):
+        start = time.time()
+        filters = json.dumps([list(self.compressor.filters), self.compressor.charset]).encode('utf-8')
+        source_map = IndexSourceMap() if self.source_maps else None
+        input_size = 0
+        outputs = []
+        for chunk in chunks:
+            content = self.get_text(chunk)
+            input_size += len(content)
+            key = hashlib.md5(filters + content.encode(self.compressor.charset)).hexdigest()
+            output = self.filter_cache.get(key)
+            if output is None:
+                output = self.filter(content)
+                self.filter_cache.set(key, output)
+            outputs.append(output)
+            if source_map is not None:
+                source_map.add_filtered(getattr(chunk, 'source', None), output)
+        output = '\n'.join(outputs)
+        self.stats = {'input_size': input_size, 'output_size': len(output), 'filter_time': time.time() - start}
+        return self.save_output(output, basename, digest, source_map)
+
+    def filter(self, content):
+        """
+        Pass content through the input and output methods of the filters, like compressor does.
+        """
+        compressor = self.compressor
+        filtered = compressor.filter(content, compressor.cached_filters, method='input', kind='js')
+        return compressor.filter_output(filtered)
+
+    def save_output(self, output, basename, digest=None, source_map=None):
+        compressor = self.compressor
+        if digest is None:
+            path = compressor.get_filepath(output, basename=basename)
+        else:
+            path = self.get_filepath(digest, basename)
+        if source_map is not None:
+            output += self.save_source_map(path, source_map)
+        content = output.encode(compressor.charset)
+        if self.precompress:
+            precompressor = Precompressor(self.precompress)
+            precompressor.write(content)
+            precompressor.save(self, path)
+        self.save(path, ContentFile(content))
+        return path
+
+    def write_streaming(self, chunks, basename, digest=None):
+        content_digest = get_content_digest()
+        # Closed once saved, which might be in the background
+        f = tempfile.TemporaryFile()
+        source_map = IndexSourceMap() if self.source_maps else None
+        precompressor = None
+        try:
+            precompressor = Precompressor(self.precompress) if self.precompress else None
+            size = 0
+            separator = b''
+            for chunk in chunks:
+                if source_map is not None:
+                    source_map.start(getattr(chunk, 'source', None))
+                # The separator is marked as neither inserted nor copied, since it is not part of any module
+                for piece, inserted in chain([(separator, None)], self.get_marked_pieces(chunk)):
+                    if isinstance(piece, text_type):
+                        piece = piece.encode(self.compressor.charset)
+                    content_digest.update(piece)
+                    f.write(piece)
+                    if precompressor is not None:
+                        precompressor.write(piece)
+                    size += len(piece)
+                    if source_map is not None and inserted is not None:
+                        source_map.add(piece, inserted)
+                if source_map is not None:
+                    source_map.end()
+                separator = b'\n'
+        except Exception:
+            f.close()
+            if precompressor is not None:
+                precompressor.close()
+            raise
+        self.stats = {'input_size': size, 'output_size': size, 'filter_time': 0}
+        path = self.get_filepath(digest or content_digest.hexdigest(), basename)
+        if source_map is not None:
+            # The file is named by its content without the reference to the map
+            comment = self.save_source_map(path, source_map).encode(self.compressor.charset)
+            f.write(comment)
+            if precompressor is not None:
+                precompressor.write(comment)
+        if precompressor is not None:
+            # Before the bundle itself, so an existing bundle has its compressed copies
+            precompressor.save(self, path)
+        self.save(path, File(f))
+        return path
+
+    def save_source_map(self, path, source_map):
+        """
+        Save the source map for the bundle at path, returning the comment referencing it to add to the bundle.
+        """
+        filename = os.path.basename(path)
+        source_map.filename = filename
+        self.save('{}.map'.format(path), ContentFile(source_map.to_json().encode('utf-8')))
+        return '\n//# sourceMappingURL={}.map'.format(filename)
+
+    @staticmethod
+    def get_pieces(chunk):
+        if isinstance(chunk, (text_type, binary_type)):
+            return [chunk]
+        return chunk
+
+    def get_marked_pieces(self, chunk):
+        if isinstance(chunk, SourceChunk):
+            return chunk.pieces
+        return ((piece, False) for piece in self.get_pieces(chunk))
+
+    def get_text(self, chunk):
+        if isinstance(chunk, text_type):
+            return chunk
+        # Copy every piece as it comes, since memory maps are closed once the next piece is asked for
+        charset = self.compressor.charset
+        content = bytearray()
+        for piece in self.get_pieces(chunk):
+            content += piece.encode(charset) if isinstance(piece, text_type) else piece
+        return content.decode(charset)
+
+    def save(self, path, content):
+        """
+        Save content to path, unless it exists. The content is closed once saved.
+        """
+        # Paths are based on the content, so an existing file has the same content
+        if self.exists(path):
+            content.close()
+            return
+
+        if self.uploads is not None:
+            self.uploads.save(path, content)
+        else:
+            try:
+                self.storage.save(path, content)
+            finally:
+                content.close()
+        if self.existing is not None:
+            self.existing.add(path)
+
+    def is_written(self, path):
+        """
+        Check whether the bundle at path exists, along with the source map and compressed copies it would get.
+        """
+        siblings = [path + PRECOMPRESSED_EXTENSIONS[f] for f in self.precompress or []]
+        if self.writes_source_maps():
+            siblings.append('{}.map'.format(path))
+        return self.exists(path) and all(self.exists(sibling) for sibling in siblings)
+
+    def writes_source_maps(self):
+        """
+        Filtered bundles only get a source map when modules are filtered one at a time.
+        """
+        return self.source_maps and (not self.compressor.cached_filters or self.filter_cache is not None)
+
+    def exists(self, path):
+        if self.existing is not None:
+            return path in self.existing
+        return self.storage.exists(path)
+
+    def get_existing_paths(self):
+        """
+        List the paths in the output directory with a single call to the storage, instead of asking the storage
+        about every path. Returns None if the storage cannot list directories.
+        """
+        directory = os.path.dirname(self.get_filepath('', 'bundle.js'))
+        try:
+            file_names = self.storage.listdir(directory)[1]
+        except NotImplementedError:
+            return None
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return set()  # Nothing written yet
+            return None
+        return set(os.path.join(directory, name) for name in file_names)
+
+    def get_filepath(self, digest, basename):
+        """
+        Build the path for the content with the given digest the same way JsCompressor.get_filepath does.
+        """
+        compressor = self.compressor
+        name = os.path.splitext(os.path.split(basename)[1])[0]
+        filename = '.'.join([name, digest[:12], compressor.type])
+        return os.path.join(compressor.output_dir, compressor.output_prefix, filename)
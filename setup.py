@@ -9,7 +9,7 @@ setup(
     url='http://github.com/bpeschier/django-compressor-requirejs',
     author="Bas Peschier",
     author_email="bpeschier@fizzgig.nl",
-    packages=['requirejs', ],
+    packages=['requirejs', 'requirejs.management', 'requirejs.management.commands'],
     license='MIT',
     long_description=long_description,
     description="Compress requirejs-modules into bundles.",